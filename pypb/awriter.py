@@ -6,24 +6,71 @@ http://stackoverflow.com/questions/2333872/atomic-writing-to-file-with-python
 
 NOTE: Wont work on Non-POSIX systems
 NOTE: Wont work with Python3
-NOTE: Only supports write (not append or r+ or w+ modes)
+NOTE: Only supports write (not append or r+ or w+ modes);
+      use SegmentWriter for appending records
 """
 
 import __builtin__
 import os
 import os.path
+import sys
+import errno
+import binascii
+import time
+import json
+import struct
+import ctypes
+import collections
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
 from contextlib import contextmanager
 from tempfile import NamedTemporaryFile as ntf
 
 import gzip
+import bz2
+import zlib
 import codecs
 
+import pypb.abs
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 TMP_SUFFIX = ".awriter_tmp"
 
-@contextmanager
-def atomic_writer(func, name, mode="wb", *args, **kwargs):
+# Linux O_TMPFILE; missing from the os module before Python 3.4
+O_TMPFILE = getattr(os, "O_TMPFILE", 0o20000000 | getattr(os, "O_DIRECTORY", 0))
+
+# Constants for linkat
+AT_FDCWD = -100
+AT_SYMLINK_FOLLOW = 0x400
+
+# Bytes of uncompressed data per block in parallel gzip
+PGZIP_BLOCKSIZE = 1024 * 1024
+
+# Default size at which a segment is sealed
+SEGMENT_BYTES = 64 * 1024 * 1024
+
+def make_tmp(name, mode):
     """
-    Make sure the data is written atomically.
+    Create an empty temporary file next to name.
+
+    Returns the absolute name and the temporary file name.
     """
 
     # Xor of the two conditions
@@ -40,16 +87,165 @@ def atomic_writer(func, name, mode="wb", *args, **kwargs):
     tname = tobj.name
     tobj.close()
 
-    # Reopen the file with proper func
-    with func(tname, mode, *args, **kwargs) as fobj:
-        yield fobj
+    return fname, tname
+
+def fsync_path(path):
+    """
+    Fsync the file or directory.
+    """
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# The C library symbols of the running process; loaded once
+try:
+    LIBC = ctypes.CDLL(None, use_errno=True)
+except OSError:
+    LIBC = None
+
+def libc_func(name):
+    """
+    Return the function from the C library; None if not available.
+    """
+
+    if LIBC is None:
+        return None
+    return getattr(LIBC, name, None)
+
+def libc_error(path):
+    """
+    Return an OSError for the errno of the last C library call.
+    """
+
+    err = ctypes.get_errno()
+    return OSError(err, os.strerror(err), path)
+
+def syncfs(path):
+    """
+    Sync the whole filesystem containing path.
+
+    Returns False if syncfs is not available.
+    """
+
+    func = libc_func("syncfs")
+    if func is None:
+        return False
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if func(fd) != 0:
+            raise libc_error(path)
+    finally:
+        os.close(fd)
+
+    return True
+
+def open_tmpfile(name, mode):
+    """
+    Open an unnamed O_TMPFILE file in the directory of name.
+
+    Returns the absolute name and the file descriptor; the descriptor is
+    None if O_TMPFILE is not supported.
+    """
+
+    if "w" not in mode:
+        raise ValueError("Write mode not selected: mode = '%s'" % mode)
+
+    fname = os.path.abspath(name)
+    if not sys.platform.startswith("linux"):
+        return fname, None
+
+    try:
+        # Same mode as the named temporary files
+        fd = os.open(os.path.dirname(fname), O_TMPFILE | os.O_WRONLY, 0o600)
+    except OSError as e:
+        # Old kernels and filesystems without O_TMPFILE support
+        if e.errno in (errno.EISDIR, errno.EOPNOTSUPP, errno.EINVAL):
+            return fname, None
+        raise
+
+    return fname, fd
+
+def link_fd(fd, fname):
+    """
+    Give a name to the O_TMPFILE file, replacing any existing file.
+    """
 
-        fobj.flush()
-        os.fsync(fobj.fileno())
+    linkat = libc_func("linkat")
+    if linkat is None:
+        raise OSError(errno.ENOSYS, "linkat not available", fname)
 
-    # Now the atomic switch
+    src = "/proc/self/fd/{}".format(fd)
+    if linkat(AT_FDCWD, src, AT_FDCWD, fname, AT_SYMLINK_FOLLOW) == 0:
+        return
+    if ctypes.get_errno() != errno.EEXIST:
+        raise libc_error(fname)
+
+    # linkat can't replace files; link to a new name and rename over
+    tname = "{}-{}{}".format(fname, binascii.hexlify(os.urandom(6)),
+                             TMP_SUFFIX)
+    if linkat(AT_FDCWD, src, AT_FDCWD, tname, AT_SYMLINK_FOLLOW) != 0:
+        raise libc_error(tname)
     os.rename(tname, fname)
 
+@contextmanager
+def atomic_writer(func, name, mode="wb", *args, **kwargs):
+    """
+    Make sure the data is written atomically.
+
+    The temporary file is removed if writing fails. The keyword arguments
+    below are used here; the rest are passed on to func.
+
+    durable - If True, also fsync the directory after the rename, so the
+              new file survives a crash. Default is False.
+    tmpfile - If True, write to an unnamed O_TMPFILE file which is linked
+              in place when done, so no temporary name is visible unless
+              the file already exists. Falls back to a named temporary
+              file if unsupported. Linux only. Default is False.
+
+    The buffer size can be set by passing buffering for the functions
+    that support it; open, copen, bz2open and pgopen.
+    """
+
+    # Steal some parameters
+    durable = kwargs.pop("durable", False)
+    tmpfile = kwargs.pop("tmpfile", False)
+
+    fd = None
+    if tmpfile:
+        fname, fd = open_tmpfile(name, mode)
+    if fd is None:
+        fname, tname = make_tmp(name, mode)
+    else:
+        tname = "/proc/self/fd/{}".format(fd)
+
+    try:
+        # Reopen the file with proper func
+        with func(tname, mode, *args, **kwargs) as fobj:
+            yield fobj
+
+        # Sync after closing; not all file objects have fileno
+        # Then the atomic switch
+        if fd is None:
+            fsync_path(tname)
+            os.rename(tname, fname)
+        else:
+            os.fsync(fd)
+            link_fd(fd, fname)
+    except BaseException:
+        if fd is None and os.path.exists(tname):
+            os.remove(tname)
+        raise
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+    if durable:
+        fsync_path(os.path.dirname(fname))
+
 def open(*args, **kwargs): # pylint: disable=redefined-builtin
     """
     Atomic context manager for open.
@@ -60,6 +256,8 @@ def open(*args, **kwargs): # pylint: disable=redefined-builtin
 def gopen(*args, **kwargs):
     """
     Atomic context manager for gzip.open
+
+    Pass compresslevel to choose the zlib level.
     """
 
     return atomic_writer(gzip.open, *args, **kwargs)
@@ -71,3 +269,417 @@ def copen(*args, **kwargs):
 
     return atomic_writer(codecs.open, *args, **kwargs)
 
+def bz2open(*args, **kwargs):
+    """
+    Atomic context manager for bz2.BZ2File
+    """
+
+    return atomic_writer(bz2.BZ2File, *args, **kwargs)
+
+def xzopen(*args, **kwargs):
+    """
+    Atomic context manager for lzma.open
+    """
+
+    if lzma is None:
+        raise ImportError("xzopen requires lzma or backports.lzma")
+    return atomic_writer(lzma.open, *args, **kwargs)
+
+def lz4open(*args, **kwargs):
+    """
+    Atomic context manager for lz4.frame.open
+    """
+
+    if lz4frame is None:
+        raise ImportError("lz4open requires lz4")
+    return atomic_writer(lz4frame.open, *args, **kwargs)
+
+def zstdopen(*args, **kwargs):
+    """
+    Atomic context manager for zstandard.open
+    """
+
+    if zstandard is None:
+        raise ImportError("zstdopen requires zstandard")
+    return atomic_writer(zstandard.open, *args, **kwargs)
+
+def compress_block(block, compresslevel, last):
+    """
+    Compress the block as part of a raw deflate stream.
+
+    Blocks other than the last end with a sync flush; so the compressed
+    blocks can be concatenated into a single deflate stream.
+    """
+
+    cobj = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    flush_mode = zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+    return cobj.compress(block) + cobj.flush(flush_mode)
+
+class PGzipFile(object):
+    """
+    Write a gzip file compressing blocks in parallel on a thread pool.
+
+    The output is a standard single member gzip file. Every blocksize bytes
+    of data are compressed independently, which costs a little compression
+    ratio. flush only writes out the blocks already compressed.
+    """
+
+    def __init__(self, filename, mode="wb", compresslevel=6, threads=None,
+                 blocksize=PGZIP_BLOCKSIZE, buffering=-1):
+        if "w" not in mode:
+            raise ValueError("Write mode not selected: mode = '%s'" % mode)
+
+        self.threads = mp.cpu_count() if threads is None else threads
+        self.compresslevel = compresslevel
+        self.blocksize = blocksize
+
+        self.fobj = __builtin__.open(filename, "wb", buffering)
+        self.pool = ThreadPool(self.threads)
+        self.pending = collections.deque()
+        self.closed = False
+
+        self.buf = []
+        self.buflen = 0
+        self.crc = zlib.crc32("")
+        self.size = 0
+
+        # Header: magic, deflate, no flags, mtime, no extra flags, unknown OS
+        mtime = struct.pack("<I", int(time.time()))
+        self.fobj.write("\037\213\010\000" + mtime + "\000\377")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, data):
+        """
+        Write the data.
+        """
+
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+
+        self.buf.append(data)
+        self.buflen += len(data)
+        if self.buflen >= self.blocksize:
+            self._submit(False)
+
+    def _submit(self, last):
+        """
+        Compress the buffered data on the pool.
+        """
+
+        block = "".join(self.buf)
+        self.buf = []
+        self.buflen = 0
+
+        args = (block, self.compresslevel, last)
+        self.pending.append(self.pool.apply_async(compress_block, args))
+
+        # Bound the memory used by blocks waiting to be written
+        while len(self.pending) > 2 * self.threads:
+            self.fobj.write(self.pending.popleft().get())
+
+    def flush(self):
+        """
+        Write the compressed blocks and flush the file.
+        """
+
+        while self.pending:
+            self.fobj.write(self.pending.popleft().get())
+        self.fobj.flush()
+
+    def fileno(self):
+        """
+        Return the file descriptor of the underlying file.
+        """
+
+        return self.fobj.fileno()
+
+    def close(self):
+        """
+        Compress the remaining data, write the trailer and close.
+        """
+
+        if self.closed:
+            return
+        self.closed = True
+
+        try:
+            self._submit(True)
+            self.flush()
+
+            trailer = struct.pack("<II", self.crc & 0xffffffff,
+                                  self.size & 0xffffffff)
+            self.fobj.write(trailer)
+        finally:
+            self.fobj.close()
+            self.pool.close()
+            self.pool.join()
+
+def pgopen(*args, **kwargs):
+    """
+    Atomic context manager for PGzipFile
+    """
+
+    return atomic_writer(PGzipFile, *args, **kwargs)
+
+class Batch(object):
+    """
+    Write many files atomically with one sync for all of them.
+
+    Files written with the writer methods go to temporary files, which are
+    only flushed. On commit the data of all files is made durable at once,
+    with syncfs if use_syncfs is True and it is available or else by
+    fsyncing the files back to back. The files are then renamed, and every
+    directory fsynced once, to make the renames durable.
+
+    Used as a context manager it commits on success and aborts,
+    removing the temporary files, on an exception.
+
+    NOTE: syncfs also flushes the unrelated dirty data on the filesystem.
+    """
+
+    def __init__(self, use_syncfs=True):
+        self.use_syncfs = use_syncfs
+        self.staged = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+    @contextmanager
+    def writer(self, func, name, mode="wb", *args, **kwargs):
+        """
+        Stage a file to be written with func.
+
+        The file is only staged if writing succeeds.
+        """
+
+        fname, tname = make_tmp(name, mode)
+
+        try:
+            with func(tname, mode, *args, **kwargs) as fobj:
+                yield fobj
+        except BaseException:
+            if os.path.exists(tname):
+                os.remove(tname)
+            raise
+
+        self.staged.append((tname, fname))
+
+    def open(self, *args, **kwargs):
+        """
+        Stage a file to be written with open.
+        """
+
+        return self.writer(__builtin__.open, *args, **kwargs)
+
+    def gopen(self, *args, **kwargs):
+        """
+        Stage a file to be written with gzip.open.
+        """
+
+        return self.writer(gzip.open, *args, **kwargs)
+
+    def copen(self, *args, **kwargs):
+        """
+        Stage a file to be written with codecs.open.
+        """
+
+        return self.writer(codecs.open, *args, **kwargs)
+
+    def commit(self):
+        """
+        Sync and rename all the staged files.
+        """
+
+        staged, self.staged = self.staged, []
+        dirnames = set(os.path.dirname(fname) for _, fname in staged)
+
+        # Sync every filesystem once, or every file
+        synced = set()
+        if self.use_syncfs:
+            for dirname in dirnames:
+                dev = os.stat(dirname).st_dev
+                if dev in synced or syncfs(dirname):
+                    synced.add(dev)
+        for tname, _ in staged:
+            if os.stat(tname).st_dev not in synced:
+                fsync_path(tname)
+
+        # Now the atomic switches
+        for tname, fname in staged:
+            os.rename(tname, fname)
+        for dirname in dirnames:
+            fsync_path(dirname)
+
+    def abort(self):
+        """
+        Remove all the staged files.
+        """
+
+        staged, self.staged = self.staged, []
+        for tname, _ in staged:
+            try:
+                os.remove(tname)
+            except OSError:
+                pass
+
+def batch(use_syncfs=True):
+    """
+    Return a Batch for writing many files atomically.
+    """
+
+    return Batch(use_syncfs)
+
+def manifest_name(dirname, prefix):
+    """
+    Return the name of the manifest of the segments.
+    """
+
+    return os.path.join(dirname, prefix + ".manifest")
+
+def read_manifest(dirname, prefix="segment"):
+    """
+    Return the list of sealed segments in the manifest.
+
+    Each segment is a dict with name, size and records.
+    """
+
+    try:
+        with __builtin__.open(manifest_name(dirname, prefix), "rb") as fobj:
+            return json.load(fobj)["segments"]
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return []
+        raise
+
+def sealed_segments(dirname, prefix="segment"):
+    """
+    Return the paths of the sealed segments, in order.
+    """
+
+    return [os.path.join(dirname, seg["name"])
+            for seg in read_manifest(dirname, prefix)]
+
+class SegmentWriter(pypb.abs.Close):
+    """
+    Append records to numbered segment files.
+
+    Records are appended to the current segment, which is written to a
+    temporary file. Once it reaches max_bytes or max_records it is sealed;
+    synced, renamed to '<prefix>.<n><suffix>' and added to the manifest,
+    which is itself written atomically. So readers only see complete
+    segments, listed in '<prefix>.manifest'; see sealed_segments.
+
+    Writing resumes after the last sealed segment; the records of an
+    unsealed segment are lost on a crash.
+
+    func is used to open the segments; eg. gzip.open with suffix '.gz'.
+    If durable is True the directory is also synced after sealing.
+    """
+
+    def __init__(self, dirname, prefix="segment", suffix="",
+                 max_bytes=SEGMENT_BYTES, max_records=None,
+                 func=__builtin__.open, durable=True):
+        self.dirname = dirname
+        self.prefix = prefix
+        self.suffix = suffix
+        self.max_bytes = max_bytes
+        self.max_records = max_records
+        self.func = func
+        self.durable = durable
+
+        self.segments = read_manifest(dirname, prefix)
+        self.seqnum = len(self.segments)
+
+        self.fobj = None
+        self.tname = None
+        self.size = 0
+        self.records = 0
+
+    def segment_name(self, seqnum):
+        """
+        Return the base name of the segment.
+        """
+
+        return "{}.{:08d}{}".format(self.prefix, seqnum, self.suffix)
+
+    def write(self, record):
+        """
+        Append the record; seal the segment if full.
+        """
+
+        if self.fobj is None:
+            name = os.path.join(self.dirname, self.segment_name(self.seqnum))
+            _, self.tname = make_tmp(name, "wb")
+            self.fobj = self.func(self.tname, "wb")
+
+        self.fobj.write(record)
+        self.size += len(record)
+        self.records += 1
+
+        if self.size >= self.max_bytes or \
+           (self.max_records is not None and self.records >= self.max_records):
+            self.seal()
+
+    def seal(self):
+        """
+        Publish the current segment, if any.
+        """
+
+        if self.fobj is None:
+            return
+
+        self.fobj.close()
+        fsync_path(self.tname)
+
+        name = self.segment_name(self.seqnum)
+        os.rename(self.tname, os.path.join(self.dirname, name))
+
+        self.segments.append({
+            "name"    : name,
+            "size"    : self.size,
+            "records" : self.records,
+        })
+        with open(manifest_name(self.dirname, self.prefix), "wb",
+                  durable=self.durable) as fobj:
+            json.dump({"segments": self.segments}, fobj, indent=1)
+
+        self.seqnum += 1
+        self.fobj = None
+        self.tname = None
+        self.size = 0
+        self.records = 0
+
+    def abort(self):
+        """
+        Drop the current segment.
+        """
+
+        if self.fobj is None:
+            return
+
+        self.fobj.close()
+        os.remove(self.tname)
+        self.fobj = None
+        self.tname = None
+        self.size = 0
+        self.records = 0
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        self.close()
+
+    @pypb.abs.runonce
+    def close(self):
+        self.seal()
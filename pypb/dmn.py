@@ -10,19 +10,29 @@ import atexit
 import tempfile
 import signal
 from datetime import datetime
+from functools import partial
 
 import daemon
 
 from pypb import exit_signal, STD_EXIT_SIGNALS
 from pypb import fnamechar, abspath
 from pypb.pstat import print_stats
+from pypb.sprof import ProfilerToggle
 
 # Constants
 LOGTIMEFMT = "%Y-%m-%dT%H:%M:%S."
 
-def daemonize(prefix=None, logdir="~/pypb_dmnlog"):
+def daemonize(prefix=None, logdir="~/pypb_dmnlog", tree_stats=False,
+              profile_signal=None):
     """
     Daemonize the process.
+
+    If tree_stats is True, the stats printed at exit include
+    the child processes.
+
+    If profile_signal is given (e.g. signal.SIGUSR2), sending it to the
+    daemon starts or stops a sampling profiler. Profiles are written
+    next to the log file.
     """
 
     logdir = abspath(logdir)
@@ -69,4 +79,8 @@ def daemonize(prefix=None, logdir="~/pypb_dmnlog"):
     dc.open()
 
     # Register the print stats function in daemon
-    atexit.register(print_stats)
+    atexit.register(partial(print_stats, tree=tree_stats))
+
+    # Setup the profiler toggle
+    if profile_signal is not None:
+        ProfilerToggle(fobj.name[:-len(".log")] + ".prof", profile_signal)
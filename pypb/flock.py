@@ -5,9 +5,33 @@ Simple file based lock.
 NOTE: Wont work on Non-POSIX systems
 """
 
+from __future__ import division, print_function
+
+import os
+import time
+import errno
 import fcntl
+import threading
 from contextlib import contextmanager
 
+import pypb.abs
+from pypb.ptable import simple_fmt_tab
+
+# Seconds to wait between attempts when acquiring with a timeout
+BACKOFF_MIN = 0.001
+BACKOFF_MAX = 0.1
+
+# The lock operations
+OPERATIONS = {
+    "exclusive" : fcntl.LOCK_EX,
+    "shared"    : fcntl.LOCK_SH,
+}
+
+class LockTimeout(IOError):
+    """
+    The lock couldn't be acquired within the timeout.
+    """
+
 @contextmanager
 def flock(fname, lock_type="exclusive", blocking=True):
     """
@@ -31,3 +55,197 @@ def flock(fname, lock_type="exclusive", blocking=True):
         yield None
 
         fcntl.lockf(fd, fcntl.LOCK_UN)
+
+class Lock(pypb.abs.Close):
+    """
+    File lock which keeps the lock file open across acquisitions.
+
+    Locks the byte range [start, start + length) using lockf;
+    length 0 means till the end of the file.
+
+    Keeps the following stats:
+        acquires   - Number of successful acquisitions
+        contended  - Acquisitions which had to wait
+        timeouts   - Acquisitions which timed out
+        wait_time  - Total seconds spent waiting
+        max_wait   - Longest wait in seconds
+        hold_time  - Total seconds the lock was held
+
+    NOTE: lockf locks are per process; they don't exclude threads.
+    """
+
+    def __init__(self, fname, start=0, length=0):
+        self.fname = fname
+        self.start = start
+        self.length = length
+
+        # Read write, as shared locks need read access
+        self.fd = os.open(fname, os.O_RDWR | os.O_CREAT, 0o666)
+
+        self.acquires = 0
+        self.contended = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.hold_time = 0.0
+        self.acquired_at = None
+
+    def _try(self, operation):
+        """
+        Try to take the lock without blocking.
+        """
+
+        try:
+            fcntl.lockf(self.fd, operation | fcntl.LOCK_NB,
+                        self.length, self.start)
+        except IOError as e:
+            if e.errno in (errno.EACCES, errno.EAGAIN):
+                return False
+            raise
+
+        return True
+
+    def acquire(self, lock_type="exclusive", timeout=None):
+        """
+        Acquire the lock.
+
+        If timeout is None, block until acquired; else try with backoff
+        and raise LockTimeout after timeout seconds. A timeout of 0 means
+        not blocking.
+        """
+
+        try:
+            operation = OPERATIONS[lock_type]
+        except KeyError:
+            raise ValueError("Invalid lock_type: '%s'" % lock_type)
+
+        if self._try(operation):
+            self.acquires += 1
+            self.acquired_at = time.time()
+            return
+
+        self.contended += 1
+        start = time.time()
+
+        if timeout is None:
+            fcntl.lockf(self.fd, operation, self.length, self.start)
+        else:
+            backoff = BACKOFF_MIN
+            while True:
+                remaining = start + timeout - time.time()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    self.wait_time += time.time() - start
+                    msg = "Lock timed out after {} seconds".format(timeout)
+                    raise LockTimeout(errno.EAGAIN, msg, self.fname)
+
+                time.sleep(min(backoff, remaining))
+                backoff = min(backoff * 2, BACKOFF_MAX)
+
+                if self._try(operation):
+                    break
+
+        now = time.time()
+        wait = now - start
+        self.wait_time += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.acquires += 1
+        self.acquired_at = now
+
+    def release(self):
+        """
+        Release the lock.
+        """
+
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, self.length, self.start)
+
+        if self.acquired_at is not None:
+            self.hold_time += time.time() - self.acquired_at
+            self.acquired_at = None
+
+    @contextmanager
+    def lock(self, lock_type="exclusive", timeout=None):
+        """
+        Hold the lock for the with block.
+        """
+
+        self.acquire(lock_type, timeout)
+        try:
+            yield None
+        finally:
+            self.release()
+
+    def stats(self):
+        """
+        Return the lock stats as a dict.
+        """
+
+        return {
+            "acquires"  : self.acquires,
+            "contended" : self.contended,
+            "timeouts"  : self.timeouts,
+            "wait_time" : self.wait_time,
+            "max_wait"  : self.max_wait,
+            "hold_time" : self.hold_time,
+        }
+
+    @pypb.abs.runonce
+    def close(self):
+        os.close(self.fd)
+
+# Locks created by get_lock; keyed by (fname, start, length)
+LOCKS = {}
+LOCKS_LOCK = threading.Lock()
+
+def get_lock(fname, start=0, length=0):
+    """
+    Return the shared Lock object for the file and byte range.
+    """
+
+    key = (os.path.abspath(fname), start, length)
+    with LOCKS_LOCK:
+        try:
+            return LOCKS[key]
+        except KeyError:
+            LOCKS[key] = lock = Lock(fname, start, length)
+            return lock
+
+def lock_stats():
+    """
+    Return the stats of the locks from get_lock; keyed by lock.
+    """
+
+    with LOCKS_LOCK:
+        return dict((key, lock.stats()) for key, lock in LOCKS.iteritems())
+
+def lock_table():
+    """
+    Return the lock stats formatted as a table; most waited first.
+    """
+
+    stats = lock_stats()
+    keys = sorted(stats, key=lambda k: stats[k]["wait_time"], reverse=True)
+
+    xss = [["Lock", "Range", "Acquires", "Contended", "Timeouts",
+            "Wait (s)", "Max Wait (s)", "Hold (s)"]]
+    for key in keys:
+        fname, start, length = key
+        st = stats[key]
+        xss.append([fname, "{}+{}".format(start, length or "EOF"),
+                    "{:,d}".format(st["acquires"]),
+                    "{:,d}".format(st["contended"]),
+                    "{:,d}".format(st["timeouts"]),
+                    "{:.3f}".format(st["wait_time"]),
+                    "{:.3f}".format(st["max_wait"]),
+                    "{:.3f}".format(st["hold_time"])])
+
+    aligns = dict((i, ">") for i in xrange(1, len(xss[0])))
+    return simple_fmt_tab(xss, aligns=aligns)
+
+def print_lock_stats(printfn=print):
+    """
+    Print the stats of the locks from get_lock.
+    """
+
+    printfn("Lock stats:")
+    printfn(lock_table())
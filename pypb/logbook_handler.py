@@ -2,7 +2,18 @@
 Logbook handlers using for sqlite3 logging and notify-send.
 """
 
+import os
+import sys
+import time
 import codecs
+import shutil
+import atexit
+import Queue
+import threading
+import traceback
+import collections
+import multiprocessing as mp
+import multiprocessing.util # pylint: disable=unused-import
 from subprocess import call
 
 from logbook.base import NOTSET, ERROR, WARNING, NOTICE
@@ -10,11 +21,25 @@ from logbook.handlers import Handler, \
                              LimitingHandlerMixin, \
                              StringFormatterHandlerMixin
 
+import pypb.abs
 import pypb.flock as flock
+import pypb.awriter as awriter
 
 EXPIRES_NEVER = 0
 EXPIRES_DEFAULT = 5
 
+# Seconds over which NotifySendHandler coalesces identical messages
+COALESCE_WINDOW = 2.0
+
+# Max distinct notifications NotifySendHandler keeps pending
+MAX_PENDING = 100
+
+# Overflow policies of QueueHandler
+QUEUE_POLICIES = ("drop_new", "drop_old", "block")
+
+# Max messages QueueWriter writes at once
+QUEUE_BATCH = 1000
+
 def notify_send(summary, text, urgency="normal", expire_time=5):
     """
     Call notify send using the given parameters.
@@ -33,18 +58,83 @@ class NotifySendHandler(Handler, StringFormatterHandlerMixin,
                         LimitingHandlerMixin):
     """
     Log using notify-send.
+
+    Notifications are sent from a background thread every
+    coalesce_window seconds; identical messages within the window are
+    sent once with their count. record_limit and record_delta limit the
+    notifications per channel and level. At most MAX_PENDING distinct
+    notifications are kept per window; the rest are counted in dropped.
+    Errors raised by the sender are printed to stderr.
+
+    sender is called as sender(summary, text, urgency, expire_time);
+    notify_send by default.
     """
 
+    # Needed by LimitingHandlerMixin; same as the logbook MailHandler
+    max_record_cache = 512
+    record_cache_prune = 0.333
+
     def __init__(self, format_string=None, record_limit=None, record_delta=None,
+                 coalesce_window=COALESCE_WINDOW, sender=notify_send,
                  level=NOTSET, filter=None, bubble=False):
 
         Handler.__init__(self, level, filter, bubble)
         StringFormatterHandlerMixin.__init__(self, format_string)
         LimitingHandlerMixin.__init__(self, record_limit, record_delta)
 
+        self.coalesce_window = coalesce_window
+        self.sender = sender
+
+        # Pending notifications with their text and count, in order
+        self.pending = collections.OrderedDict()
+        self.pending_lock = threading.Lock()
+        self.dropped = 0
+
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+        atexit.register(self.close)
+
+    def hash_record(self, record):
+        """
+        Rate limit per channel and level.
+        """
+
+        return record.channel, record.level
+
+    def _run(self):
+        """
+        Send the pending notifications every window till closed.
+        """
+
+        while not self.done.wait(self.coalesce_window):
+            self.deliver()
+
+    def deliver(self):
+        """
+        Send the pending notifications.
+        """
+
+        with self.pending_lock:
+            pending, self.pending = self.pending, collections.OrderedDict()
+
+        for key, (text, count) in pending.iteritems():
+            summary, _, urgency, expire_time = key
+            if count > 1:
+                text = u"{} (x{})".format(text, count)
+
+            # Keep delivering; eg. notify-send may not be installed
+            try:
+                self.sender(summary, text, urgency, expire_time)
+            except Exception: # pylint: disable=broad-except
+                msg = "NotifySendHandler: sending notification failed\n"
+                sys.stderr.write(msg + traceback.format_exc())
+
     def emit(self, record):
         """
-        Log the record.
+        Queue the record for notification.
         """
 
         if not self.check_delivery(record)[1]:
@@ -71,7 +161,22 @@ class NotifySendHandler(Handler, StringFormatterHandlerMixin,
         else:
             urgency = "low"
 
-        notify_send(summary, text, urgency, expire_time)
+        # The formatted text may have the time; compare the messages
+        key = (summary, record.message, urgency, expire_time)
+        with self.pending_lock:
+            if key in self.pending:
+                self.pending[key][1] += 1
+            elif len(self.pending) < MAX_PENDING:
+                self.pending[key] = [text, 1]
+            else:
+                self.dropped += 1
+
+    @pypb.abs.runonce
+    def close(self):
+        self.done.set()
+        self.thread.join()
+
+        self.deliver()
 
 class LockedFileHandler(Handler, StringFormatterHandlerMixin):
     """
@@ -86,32 +191,384 @@ class LockedFileHandler(Handler, StringFormatterHandlerMixin):
 
         self.filename = filename
         self.lock_filename = filename + ".lock"
+        self.lock = flock.get_lock(self.lock_filename)
 
-    def emit(self, record):
+    def write_messages(self, messages):
         """
-        Log the record.
+        Write the messages to the file under the lock.
         """
 
-        with flock.flock(self.lock_filename):
+        with self.lock.lock():
             with codecs.open(self.filename, mode="ab", encoding="utf-8") as fobj:
-                message = self.format(record) + "\n"
-                fobj.write(message)
+                for message in messages:
+                    fobj.write(message)
 
                 fobj.flush()
 
+    def emit(self, record):
+        """
+        Log the record.
+        """
+
+        self.write_messages([self.format(record) + "\n"])
+
     def emit_batch(self, records, reason):
         """
         Log multiple records.
         """
 
-        with flock.flock(self.lock_filename):
+        self.write_messages([self.format(record) + "\n" for record in records])
+
+class BufferedLockedFileHandler(LockedFileHandler):
+    """
+    Log to a file, writing the records in batches.
+
+    Formatted records are buffered and written in one batch once
+    buffer_size records are buffered, every flush_interval seconds, on a record at
+    or above flush_level and at exit. The file is kept open between
+    batches and reopened if it is moved away; eg. on rotation.
+
+    Forked processes, eg. the ProcessFarm tasks, start with an empty
+    buffer and their own flush thread. As multiprocessing children exit
+    without running atexit, they flush with a multiprocessing finalizer
+    instead; so the records of a task are written when the task ends.
+    Records of processes killed or exiting with os._exit are lost.
+    """
+
+    def __init__(self, filename, format_string=None, buffer_size=1000,
+                 flush_interval=1.0, flush_level=ERROR,
+                 level=NOTSET, filter=None, bubble=False):
+
+        LockedFileHandler.__init__(self, filename, format_string,
+                                   level, filter, bubble)
+
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.flush_level = flush_level
+
+        self._start()
+        atexit.register(self.close)
+
+    def _start(self):
+        """
+        Start with an empty buffer and a new flush thread.
+        """
+
+        self.pid = os.getpid()
+
+        self.fobj = None
+        self.buffer = []
+        self.buffer_lock = threading.Lock()
+
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _check_fork(self):
+        """
+        Start afresh in a forked process.
+
+        The buffered records belong to the parent, which writes them.
+        """
+
+        if self.pid == os.getpid():
+            return
+
+        self._start()
+        mp.util.Finalize(self, self.flush, exitpriority=10)
+
+    def _run(self):
+        """
+        Flush the buffer every flush_interval seconds till closed.
+        """
+
+        while not self.done.wait(self.flush_interval):
+            self.flush()
+
+    def _get_fobj(self):
+        """
+        Return the open file; reopen it if it was moved away.
+        """
+
+        if self.fobj is not None:
+            try:
+                moved = os.stat(self.filename).st_ino != \
+                        os.fstat(self.fobj.fileno()).st_ino
+            except OSError:
+                moved = True
+            if moved:
+                self.fobj.close()
+                self.fobj = None
+
+        if self.fobj is None:
+            self.fobj = codecs.open(self.filename, mode="ab", encoding="utf-8")
+
+        return self.fobj
+
+    def write_messages(self, messages):
+        """
+        Write the messages to the open file under the lock.
+        """
+
+        with self.lock.lock():
+            fobj = self._get_fobj()
+            for message in messages:
+                fobj.write(message)
+
+            fobj.flush()
+
+    def emit(self, record):
+        """
+        Buffer the record.
+        """
+
+        self._check_fork()
+
+        # Format now; cheaper than keeping the record with its context
+        message = self.format(record) + "\n"
+
+        with self.buffer_lock:
+            self.buffer.append(message)
+            full = len(self.buffer) >= self.buffer_size
+
+        if full or record.level >= self.flush_level:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered records.
+        """
+
+        self._check_fork()
+
+        with self.buffer_lock:
+            messages, self.buffer = self.buffer, []
+            if messages:
+                self.write_messages(messages)
+
+    @pypb.abs.runonce
+    def close(self):
+        self.done.set()
+        self.thread.join()
+
+        self.flush()
+        if self.fobj is not None:
+            self.fobj.close()
+
+class RotatingLockedFileHandler(LockedFileHandler):
+    """
+    Log to a file, rotating it by size or time.
+
+    Before writing, under the lock, the file is rotated if it is at least
+    max_bytes long or was last written in an earlier rotate_interval
+    seconds long period. So any number of processes can log to the same
+    file. The file is renamed to '<filename>.<timestamp>' and, if
+    compress is True, gzipped in a background thread to
+    '<filename>.<timestamp>.gz'.
+    """
+
+    def __init__(self, filename, format_string=None, max_bytes=None,
+                 rotate_interval=None, compress=True,
+                 level=NOTSET, filter=None, bubble=False):
+
+        LockedFileHandler.__init__(self, filename, format_string,
+                                   level, filter, bubble)
+
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.compress = compress
+        self.compressors = []
+
+    def should_rotate(self):
+        """
+        Check if the file needs to be rotated.
+        """
+
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return False
+
+        if st.st_size == 0:
+            return False
+        if self.max_bytes is not None and st.st_size >= self.max_bytes:
+            return True
+        if self.rotate_interval is not None:
+            period = int(time.time() // self.rotate_interval)
+            return int(st.st_mtime // self.rotate_interval) < period
+
+        return False
+
+    def rotate(self):
+        """
+        Rename the file and compress it in the background.
+        """
+
+        rotated = "{}.{}".format(self.filename, time.strftime("%Y%m%d-%H%M%S"))
+        suffix = 1
+        while os.path.exists(rotated) or os.path.exists(rotated + ".gz"):
+            rotated = "{}.{}.{}".format(self.filename,
+                                        time.strftime("%Y%m%d-%H%M%S"), suffix)
+            suffix += 1
+
+        os.rename(self.filename, rotated)
+
+        if self.compress:
+            thread = threading.Thread(target=compress_file, args=(rotated,))
+            thread.start()
+            self.compressors = [t for t in self.compressors if t.is_alive()]
+            self.compressors.append(thread)
+
+    def write_messages(self, messages):
+        """
+        Write the messages to the file under the lock; rotate if needed.
+        """
+
+        with self.lock.lock():
+            if self.should_rotate():
+                self.rotate()
+
             with codecs.open(self.filename, mode="ab", encoding="utf-8") as fobj:
-                for record in records:
-                    message = self.format(record) + "\n"
+                for message in messages:
                     fobj.write(message)
 
                 fobj.flush()
 
+    def close(self):
+        """
+        Wait for the compressions to finish.
+        """
+
+        for thread in self.compressors:
+            thread.join()
+        self.compressors = []
+
+def compress_file(fname):
+    """
+    Gzip the file atomically to fname.gz and remove it.
+    """
+
+    with open(fname, "rb") as src:
+        with awriter.gopen(fname + ".gz", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+
+    os.remove(fname)
+
+class QueueHandler(Handler, StringFormatterHandlerMixin):
+    """
+    Log by putting the formatted records on a queue.
+
+    Use a bounded queue; eg. from TaskFarm.make_queue(maxsize), and drain
+    it with a QueueWriter. When the queue is full the policy decides:
+        drop_new - Drop the new record.
+        drop_old - Drop the oldest queued record.
+        block    - Wait for space.
+    The number of dropped records is kept in dropped.
+    """
+
+    def __init__(self, queue, policy="drop_new", format_string=None,
+                 level=NOTSET, filter=None, bubble=False):
+
+        Handler.__init__(self, level, filter, bubble)
+        StringFormatterHandlerMixin.__init__(self, format_string)
+
+        if policy not in QUEUE_POLICIES:
+            raise ValueError("Invalid policy: '%s'" % policy)
+
+        self.queue = queue
+        self.policy = policy
+        self.dropped = 0
+
+    def emit(self, record):
+        """
+        Put the formatted record on the queue.
+        """
+
+        message = self.format(record) + "\n"
+
+        if self.policy == "block":
+            self.queue.put(message)
+            return
+
+        try:
+            self.queue.put_nowait(message)
+            return
+        except Queue.Full:
+            pass
+
+        if self.policy == "drop_old":
+            try:
+                self.queue.get_nowait()
+            except Queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(message)
+            except Queue.Full:
+                pass
+
+        self.dropped += 1
+
+class QueueWriter(pypb.abs.Close):
+    """
+    Write the messages from a QueueHandler queue to the target.
+
+    The target is an object with write_messages; eg. a LockedFileHandler,
+    a file object or a file name, which is written with a
+    LockedFileHandler. Runs in a thread or, if process is True, in a
+    process. Closing writes the remaining messages.
+    """
+
+    def __init__(self, queue, target, process=False):
+        if isinstance(target, basestring):
+            target = LockedFileHandler(target)
+
+        self.queue = queue
+        self.target = target
+
+        if process:
+            self.worker = mp.Process(target=self._run)
+        else:
+            self.worker = threading.Thread(target=self._run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def _write(self, messages):
+        """
+        Write the messages to the target.
+        """
+
+        if hasattr(self.target, "write_messages"):
+            self.target.write_messages(messages)
+        else:
+            self.target.write("".join(messages))
+            self.target.flush()
+
+    def _run(self):
+        """
+        Write the messages in batches till None is received.
+        """
+
+        done = False
+        while not done:
+            messages = [self.queue.get()]
+            while len(messages) < QUEUE_BATCH:
+                try:
+                    messages.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            if None in messages:
+                messages = messages[:messages.index(None)]
+                done = True
+            if messages:
+                self._write(messages)
+
+    @pypb.abs.runonce
+    def close(self):
+        self.queue.put(None)
+        self.worker.join()
+
 def main():
     import logbook
 
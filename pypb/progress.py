@@ -5,12 +5,32 @@ Measure the progress of loops.
 from __future__ import division, print_function
 
 import sys
+import abc
+import json
 import time as _time
+import ctypes
+import collections
+import threading
+import multiprocessing as mp
+from itertools import islice
+
+from logbook import Logger, INFO
+
+import pypb.abs
 
 DEFAULT_MSG = ("{count:,d} ({percentage:.1f} %) "
                "- elapsed: {elapsed} - eta: {eta} "
                "- {speed:.2f} loops/sec")
 
+SHARED_MSG = DEFAULT_MSG + " - workers: {workers}"
+
+# Number of clock checks per mininterval in adaptive mode
+CLOCK_CHECKS = 4
+
+# Max items between clock checks in adaptive mode; bounds the time the
+# display can freeze when the items suddenly get slow
+MAX_BATCH = 1024
+
 def td_fmt(td):
     """
     Humanize time difference in seconds.
@@ -31,15 +51,19 @@ def td_fmt(td):
     return s
 
 # pylint: disable=unused-variable
-def make_kwargs(start, total, now, count, pnow, pcount):
+def make_kwargs(start, total, now, count, pnow, pcount, speed=None):
     """
     Make kwargs for progress func.
+
+    If speed is not given it is computed from the last interval.
     """
 
     td = now - pnow
 
     # Compute speed
-    if td:
+    if speed is not None:
+        pass
+    elif td:
         speed = (count - pcount) / td
     else:
         speed = 0.0
@@ -59,14 +83,144 @@ def make_kwargs(start, total, now, count, pnow, pcount):
     # Compute elapsed
     elapsed = now - start
 
+    # Keep the raw values for metrics
+    eta_secs = eta
+    elapsed_secs = elapsed
+
     # Format int
     eta = td_fmt(eta)
     elapsed = td_fmt(elapsed)
 
     return locals()
 
+def emit_sample(sinks, kwargs):
+    """
+    Send a sample made from the progress kwargs to the sinks.
+    """
+
+    if not sinks:
+        return
+
+    sample = {
+        "time"       : kwargs["now"],
+        "count"      : kwargs["count"],
+        "total"      : kwargs["total"],
+        "percentage" : kwargs["percentage"],
+        "elapsed"    : kwargs["elapsed_secs"],
+        "eta"        : kwargs["eta_secs"],
+        "speed"      : kwargs["speed"],
+    }
+    for sink in sinks:
+        sink.emit(sample)
+
+class MetricsSink(pypb.abs.Close):
+    """
+    Base class for receivers of progress samples.
+
+    A sample is a dict with the keys time, count, total, percentage,
+    elapsed, eta and speed; times are in seconds. If name is given
+    it is added to every sample.
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+
+    def emit(self, sample):
+        """
+        Receive a sample.
+        """
+
+        if self.name is not None:
+            sample = dict(sample, name=self.name)
+        self.write(sample)
+
+    @abc.abstractmethod
+    def write(self, sample):
+        pass
+
+    @pypb.abs.runonce
+    def close(self):
+        pass
+
+class JsonLinesSink(MetricsSink):
+    """
+    Append samples to a file as JSON lines.
+    """
+
+    def __init__(self, fname, name=None):
+        super(JsonLinesSink, self).__init__(name)
+
+        self.fobj = open(fname, "a")
+
+    def write(self, sample):
+        self.fobj.write(json.dumps(sample, sort_keys=True) + "\n")
+        self.fobj.flush()
+
+    @pypb.abs.runonce
+    def close(self):
+        self.fobj.close()
+
+class LogbookSink(MetricsSink):
+    """
+    Log samples as Logbook records with the sample in the extra fields.
+    """
+
+    def __init__(self, logger=None, level=INFO, name=None):
+        super(LogbookSink, self).__init__(name)
+
+        self.logger = Logger(__name__) if logger is None else logger
+        self.level = level
+
+    def write(self, sample):
+        msg = "Progress: {} items - {:.2f} loops/sec"
+        msg = msg.format(sample["count"], sample["speed"])
+        self.logger.log(self.level, msg, extra=sample)
+
+class MemorySink(MetricsSink):
+    """
+    Keep the last maxlen samples in memory.
+    """
+
+    def __init__(self, maxlen=None, name=None):
+        super(MemorySink, self).__init__(name)
+
+        self.samples = collections.deque(maxlen=maxlen)
+
+    def write(self, sample):
+        self.samples.append(sample)
+
+    def series(self, key):
+        """
+        Return the list of (time, value) for the given key.
+        """
+
+        return [(s["time"], s[key]) for s in self.samples]
+
+def make_printer(msg, logfn, clean):
+    """
+    Return the function used to print the progress message.
+    """
+
+    # Setup clean
+    if clean not in (True, False, None):
+        raise ValueError("Invalid value for parameter 'clean'")
+    if clean is None and "\n" not in msg:
+        clean = sys.stdout.isatty()
+
+    # Define the print function
+    if clean:
+        def myprint(newmsg, lastmsg):
+            print("\r" + " " * len(lastmsg), end="")
+            print("\r" + newmsg, end="")
+            sys.stdout.flush()
+    else:
+        def myprint(newmsg, _):
+            logfn(newmsg)
+
+    return myprint
+
 # pylint: disable=line-too-long
-def progress(iterable, msg=None, total=None, mininterval=1, logfn=print, clean=None):
+def progress(iterable, msg=None, total=None, mininterval=1, logfn=print, clean=None, adaptive=False, sinks=()):
     """
     Print progress of loop iteration.
 
@@ -79,6 +233,12 @@ def progress(iterable, msg=None, total=None, mininterval=1, logfn=print, clean=N
                   Default is 'auto'. Note: Make sure to set clean=False
                   if using a custom logfn. Otherwise it will ignore logfn
                   if stdout is a tty.
+    adaptive    - If True check the clock only every K items, where K is
+                  adjusted from the observed speed to check the clock
+                  about CLOCK_CHECKS times every mininterval. K is at
+                  most MAX_BATCH.
+    sinks       - MetricsSink objects which get a sample of the progress
+                  every time it is printed.
 
     The format method of the `msg' parameter is called with the following
     keyword arguments before updating the progress.
@@ -98,22 +258,7 @@ def progress(iterable, msg=None, total=None, mininterval=1, logfn=print, clean=N
     count = 0
     msg = DEFAULT_MSG if msg is None else msg
     msg_fmt = msg.format
-
-    # Setup clean
-    if clean not in (True, False, None):
-        raise ValueError("Invalid value for parameter 'clean'")
-    if clean is None and "\n" not in msg:
-        clean = sys.stdout.isatty()
-
-    # Define the print function
-    if clean:
-        def myprint(newmsg, lastmsg):
-            print("\r" + " " * len(lastmsg), end="")
-            print("\r" + newmsg, end="")
-            sys.stdout.flush()
-    else:
-        def myprint(newmsg, _):
-            logfn(newmsg)
+    myprint = make_printer(msg, logfn, clean)
 
     # try to get the number of loops from here
     if total is None:
@@ -127,6 +272,45 @@ def progress(iterable, msg=None, total=None, mininterval=1, logfn=print, clean=N
     pcount = count
     lastmsg = ""
 
+    # Yield items in batches of k, checking the clock once per batch
+    if adaptive:
+        iterator = iter(iterable)
+        k = 1
+        pcheck = start
+
+        while True:
+            n = 0
+            for n, item in enumerate(islice(iterator, k), 1):
+                yield item
+
+            count += n
+            now = time()
+
+            if now - pnow >= mininterval:
+                kwargs = make_kwargs(start, total, now, count, pnow, pcount)
+                newmsg = msg_fmt(**kwargs)
+                myprint(newmsg, lastmsg)
+                emit_sample(sinks, kwargs)
+
+                pnow = now
+                pcount = count
+                lastmsg = newmsg
+
+            if n < k:
+                break
+
+            # Resize the batch; grow at most twice at a time
+            td = now - pcheck
+            if td > 0:
+                k = int(k * (mininterval / CLOCK_CHECKS) / td)
+                k = max(1, min(k, 2 * n))
+            else:
+                k = 2 * n
+            k = min(k, MAX_BATCH)
+            pcheck = now
+
+        iterable = ()
+
     # Yield an item
     for item in iterable:
         yield item
@@ -140,6 +324,7 @@ def progress(iterable, msg=None, total=None, mininterval=1, logfn=print, clean=N
             kwargs = make_kwargs(start, total, now, count, pnow, pcount)
             newmsg = msg_fmt(**kwargs)
             myprint(newmsg, lastmsg)
+            emit_sample(sinks, kwargs)
 
             # Update the time
             pnow = now
@@ -152,6 +337,210 @@ def progress(iterable, msg=None, total=None, mininterval=1, logfn=print, clean=N
     kwargs = make_kwargs(start, total, now, count, pnow, pcount)
     newmsg = msg_fmt(**kwargs)
     myprint(newmsg, lastmsg)
+    emit_sample(sinks, kwargs)
+
+class Reporter(pypb.abs.Close):
+    """
+    Print progress from a background thread.
+
+    The loop only calls update; a daemon thread prints the progress every
+    mininterval seconds, even if the loop is blocked. The weight passed to
+    update (1 by default) may be anything countable like bytes or chunk
+    sizes; total should be in the same unit.
+
+    The speed, and so the eta, is an exponential moving average of the
+    speed in each interval; smoothing is the weight of the last interval.
+    The other parameters are the same as for progress.
+    """
+
+    def __init__(self, msg=None, total=None, mininterval=1, logfn=print,
+                 clean=None, smoothing=0.3, sinks=()):
+        self.count = 0
+        self.sinks = sinks
+        self.total = 0 if total is None else total
+        self.mininterval = mininterval
+        self.smoothing = smoothing
+
+        msg = DEFAULT_MSG if msg is None else msg
+        self.msg_fmt = msg.format
+        self.myprint = make_printer(msg, logfn, clean)
+
+        self.start = _time.time()
+        self.pnow = self.start
+        self.pcount = 0
+        self.speed = None
+        self.lastmsg = ""
+
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def update(self, weight=1):
+        """
+        Add weight to the count.
+        """
+
+        self.count += weight
+
+    def current(self):
+        """
+        Return the current count.
+        """
+
+        return self.count
+
+    def extra_kwargs(self, now): # pylint: disable=unused-argument,no-self-use
+        """
+        Return additional kwargs for the progress message.
+        """
+
+        return {}
+
+    def _run(self):
+        """
+        Print the progress till closed.
+        """
+
+        while not self.done.wait(self.mininterval):
+            self.report()
+
+    def report(self):
+        """
+        Print the current progress.
+        """
+
+        now = _time.time()
+        count = self.current()
+
+        # A short interval, as in the final report right after a tick,
+        # makes a noisy speed; keep the last speed or use the average
+        td = now - self.pnow
+        if td >= self.mininterval or (self.speed is None and td):
+            if td < self.mininterval:
+                speed = count / (now - self.start)
+            else:
+                speed = (count - self.pcount) / td
+            if self.speed is not None:
+                speed = (self.smoothing * speed
+                         + (1 - self.smoothing) * self.speed)
+            self.speed = speed
+
+        kwargs = make_kwargs(self.start, self.total, now, count,
+                             self.pnow, self.pcount, self.speed or 0.0)
+        kwargs.update(self.extra_kwargs(now))
+        newmsg = self.msg_fmt(**kwargs)
+        self.myprint(newmsg, self.lastmsg)
+        emit_sample(self.sinks, kwargs)
+
+        self.pnow = now
+        self.pcount = count
+        self.lastmsg = newmsg
+
+    @pypb.abs.runonce
+    def close(self):
+        self.done.set()
+        self.thread.join()
+
+        # Make sure to print the last output line
+        self.report()
+
+class WorkerCounter(object):
+    """
+    Progress counter of one worker, backed by shared memory.
+    """
+
+    def __init__(self, counts, slot):
+        self.counts = counts
+        self.slot = slot
+
+    def update(self, weight=1):
+        """
+        Add weight to the count of this worker.
+        """
+
+        self.counts[self.slot] += weight
+
+    def progress(self, iterable, batch=1000):
+        """
+        Count the items of the iterable, updating every batch items.
+        """
+
+        n = 0
+        for item in iterable:
+            yield item
+
+            n += 1
+            if n == batch:
+                self.counts[self.slot] += n
+                n = 0
+
+        self.counts[self.slot] += n
+
+class SharedProgress(Reporter):
+    """
+    Print the combined progress of multiple worker processes.
+
+    Every worker gets a counter in shared memory from counter(slot),
+    which it updates without any locking or messages. So every slot must
+    only be updated by one process at a time. The counters are shared by
+    inheritance, so they must be passed to processes when they are
+    created, as with ProcessFarm.spawn.
+
+    The progress message gets the additional keyword argument workers with
+    the speed of each worker over the last interval.
+    """
+
+    def __init__(self, num_workers, msg=None, **kwargs):
+        self.counts = mp.RawArray(ctypes.c_ulonglong, num_workers)
+        self.pcounts = [0] * num_workers
+
+        msg = SHARED_MSG if msg is None else msg
+        super(SharedProgress, self).__init__(msg=msg, **kwargs)
+
+    def counter(self, slot):
+        """
+        Return the counter for the given slot.
+        """
+
+        return WorkerCounter(self.counts, slot)
+
+    def current(self):
+        return sum(self.counts) + self.count
+
+    def extra_kwargs(self, now):
+        counts = self.counts[:]
+
+        td = now - self.pnow
+        if td:
+            speeds = [(c - p) / td for c, p in zip(counts, self.pcounts)]
+        else:
+            speeds = [0.0] * len(counts)
+        self.pcounts = counts
+
+        workers = " ".join("{:.1f}".format(s) for s in speeds)
+        return {"workers": workers}
+
+def bgprogress(iterable, weight=None, total=None, **kwargs):
+    """
+    Print progress of loop iteration from a background thread.
+
+    weight is an optional function returning the weight of an item;
+    for example len when iterating over chunks. The remaining arguments are
+    passed to Reporter.
+    """
+
+    # try to get the number of loops from here
+    if total is None and weight is None:
+        try:
+            total = len(iterable)
+        except TypeError:
+            total = 0
+
+    with Reporter(total=total, **kwargs) as reporter:
+        for item in iterable:
+            yield item
+            reporter.update(1 if weight is None else weight(item))
 
 def prange(*args, **kwargs):
     """
@@ -160,11 +549,52 @@ def prange(*args, **kwargs):
 
     return progress(xrange(*args), **kwargs)
 
+def benchmark(n=10000000):
+    """
+    Compare the overhead of progress against a bare loop.
+
+    The generator case is a loop over a plain pass through generator, the
+    least any wrapper generator can cost.
+    """
+
+    def noop(_):
+        pass
+
+    def bare():
+        for _ in xrange(n):
+            pass
+
+    def passthru(iterable):
+        for item in iterable:
+            yield item
+
+    def generator():
+        for _ in passthru(xrange(n)):
+            pass
+
+    def plain():
+        for _ in progress(xrange(n), logfn=noop, clean=False):
+            pass
+
+    def adaptive():
+        for _ in progress(xrange(n), logfn=noop, clean=False, adaptive=True):
+            pass
+
+    for fn in [bare, generator, plain, adaptive]:
+        start = _time.time()
+        fn()
+        td = _time.time() - start
+        print("{:10s}: {:.3f} sec - {:.1f} ns/loop".format(fn.__name__, td,
+                                                           td / n * 1e9))
+
 def main():
     for i in prange(1000000):
         # _time.sleep(1)
         pass
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ["bench"]:
+        benchmark()
+    else:
+        main()
 
@@ -5,16 +5,42 @@ All results returned are in bytes.
 Recipe copied from http://code.activestate.com/recipes/286222-memory-usage/
 """
 
-from __future__ import print_function
+from __future__ import division, print_function
 
 __all__    = ["vm", "rss", "max_vm", "max_rss",
               "io_read", "io_write",
               "disk_io_read", "disk_io_write",
               "vol_ctxt_switches", "nonvol_ctxt_switches",
+              "cpu_times", "snapshot", "Snapshot", "Sampler",
+              "section", "profile", "section_stats",
+              "descendants", "tree_snapshots", "children_usage",
+              "AllocTracker", "track_allocations",
               "print_stats"]
 
+import os
+import gc
+import sys
+import csv
+import json
+import time
+import atexit
+import resource
+import threading
+import itertools
+import collections
 from os import getpid
 from datetime import datetime
+from functools import wraps
+from contextlib import contextmanager
+
+import pypb.abs
+import pypb.awriter as awriter
+from pypb.ptable import simple_fmt_tab
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
 
 SCALE = {"kB": 1024.0, "mB": 1024.0 * 1024.0,
          "KB": 1024.0, "MB": 1024.0 * 1024.0}
@@ -24,154 +50,897 @@ MEGA = 2 ** 20
 # Note start time
 START = datetime.utcnow()
 
-def get_vm_data(VmKey):
+# Clock ticks per second used in /proc/<pid>/stat
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+
+# Fields of the samples taken by Sampler
+SAMPLE_FIELDS = ["time", "vm", "rss",
+                 "io_read", "io_write", "disk_io_read", "disk_io_write",
+                 "utime", "stime"]
+
+# Max objects measured by gc_types
+GC_MAX_SAMPLES = 100000
+
+# Separator between the names of nested sections
+SECTION_SEP = " > "
+
+# Max bytes read from a proc file
+PROC_READ_SIZE = 64 * 1024
+
+# Snapshot fields read from /proc/<pid>/status
+STATUS_KEYS = {
+    "VmSize"                     : "vm",
+    "VmRSS"                      : "rss",
+    "VmPeak"                     : "max_vm",
+    "VmHWM"                      : "max_rss",
+    "voluntary_ctxt_switches"    : "vol_ctxt_switches",
+    "nonvoluntary_ctxt_switches" : "nonvol_ctxt_switches",
+}
+
+# Snapshot fields read from /proc/<pid>/io
+IO_KEYS = {
+    "rchar"       : "io_read",
+    "wchar"       : "io_write",
+    "read_bytes"  : "disk_io_read",
+    "write_bytes" : "disk_io_write",
+}
+
+# Proc file key of every snapshot field
+FIELD_KEYS = dict((v, k) for keys in (STATUS_KEYS, IO_KEYS)
+                  for k, v in keys.iteritems())
+
+def pread(fd, size, offset):
     """
-    Read the proc file and get virtual mem usage data.
+    Read from the offset of the file; os.pread is missing before Python 3.3.
     """
 
-    fname = "/proc/{0}/status".format(getpid())
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+pread = getattr(os, "pread", pread) # pylint: disable=invalid-name
+
+class ProcFile(object):
+    """
+    A proc file of the current process kept open for re-reading.
+
+    The file is reopened if the pid changes, as after a fork. Reads are
+    serialized by a lock, as the lseek + read fallback of pread moves the
+    offset shared by all the threads.
+    """
+
+    __slots__ = ["name", "pid", "fd", "ident", "lock", "lock_pid"]
+
+    def __init__(self, name):
+        self.name = name
+        self.pid = None
+        self.fd = None
+        self.ident = None
+        self.lock = threading.Lock()
+        self.lock_pid = getpid()
+
+    def read(self):
+        """
+        Return the current contents of the file; empty if unreadable.
+        """
+
+        pid = getpid()
+        if pid != self.lock_pid:
+            # The lock may have been held by another thread at fork
+            self.lock = threading.Lock()
+            self.lock_pid = pid
+
+        with self.lock:
+            try:
+                if pid != self.pid:
+                    self._close_inherited()
+                    fname = "/proc/{0}/{1}".format(pid, self.name)
+                    self.fd = os.open(fname, os.O_RDONLY)
+                    st = os.fstat(self.fd)
+                    self.ident = (st.st_dev, st.st_ino)
+                    self.pid = pid
+
+                return pread(self.fd, PROC_READ_SIZE, 0)
+            except OSError:
+                # non-Linux ?
+                return ""
+
+    def _close_inherited(self):
+        """
+        Close the fd inherited from the parent, if still the proc file.
+
+        The fd may have been closed and its number reused after the
+        fork; eg. daemonizing closes all the fds.
+        """
+
+        fd, self.fd = self.fd, None
+        if fd is None:
+            return
+
+        try:
+            st = os.fstat(fd)
+        except OSError:
+            return
+        if (st.st_dev, st.st_ino) == self.ident:
+            os.close(fd)
+
+STATUS_FILE = ProcFile("status")
+IO_FILE = ProcFile("io")
+STAT_FILE = ProcFile("stat")
+
+def read_proc_file(pid, name):
+    """
+    Return the contents of a proc file of any process; empty if unreadable.
+    """
 
     try:
-        fobj = open(fname)
+        with open("/proc/{0}/{1}".format(pid, name)) as fobj:
+            return fobj.read()
     except IOError:
-        # non-Linux ?
-        return 0.0
-
-    with fobj:
-        for line in fobj:
-            if line.startswith(VmKey):
-                try:
-                    _, w1, w2 = line.split()
-                except ValueError:
-                    # Unknown format ?
-                    return 0.0
-
-                return float(w1) * SCALE[w2]
-        # Unknown key ?
-        return 0.0
+        return ""
+
+class Snapshot(object):
+    """
+    Values read from the proc files at one point in time.
+
+    Sizes are in bytes, cpu times in seconds.
+    Values which could not be read are zero.
+    """
+
+    __slots__ = ["time", "vm", "rss", "max_vm", "max_rss",
+                 "vol_ctxt_switches", "nonvol_ctxt_switches",
+                 "io_read", "io_write", "disk_io_read", "disk_io_write",
+                 "utime", "stime"]
+
+    def __init__(self):
+        self.time = time.time()
+
+        self.vm = self.rss = self.max_vm = self.max_rss = 0.0
+        self.vol_ctxt_switches = self.nonvol_ctxt_switches = 0
+        self.io_read = self.io_write = 0
+        self.disk_io_read = self.disk_io_write = 0
+        self.utime = self.stime = 0.0
+
+    def parse_fields(self, data, keys):
+        """
+        Parse the "key: value [unit]" lines of a proc file.
+        """
+
+        # Searching for the keys is faster than splitting all the lines
+        data = "\n" + data
+        for key, attr in keys.iteritems():
+            start = data.find("\n" + key + ":")
+            if start < 0:
+                continue
+
+            start += len(key) + 2
+            end = data.find("\n", start)
+            words = data[start:end].split() if end >= 0 else data[start:].split()
+            try:
+                if len(words) == 2:
+                    setattr(self, attr, float(words[0]) * SCALE[words[1]])
+                else:
+                    setattr(self, attr, int(words[0]))
+            except (IndexError, KeyError, ValueError):
+                # Unknown format ?
+                pass
+
+    def parse_status(self, data):
+        """
+        Parse the contents of /proc/<pid>/status.
+        """
+
+        self.parse_fields(data, STATUS_KEYS)
+
+    def parse_io(self, data):
+        """
+        Parse the contents of /proc/<pid>/io.
+        """
+
+        self.parse_fields(data, IO_KEYS)
+
+    def parse_stat(self, data):
+        """
+        Parse the contents of /proc/<pid>/stat.
+        """
+
+        # The command name may contain spaces; fields after it are fixed
+        fields = data[data.rfind(")") + 2:].split()
+        try:
+            self.utime = int(fields[11]) / CLK_TCK
+            self.stime = int(fields[12]) / CLK_TCK
+        except (IndexError, ValueError):
+            # Unknown format ?
+            pass
+
+def snapshot(pid=None, status=True, io=True, stat=True):
+    """
+    Return a Snapshot reading each of the requested proc files once.
+
+    If pid is None the current process is read using proc files
+    kept open across calls.
+    """
+
+    snap = Snapshot()
+
+    if pid is None:
+        if status:
+            snap.parse_status(STATUS_FILE.read())
+            snap.max_rss = max(snap.max_rss, reset_peak())
+        if io:
+            snap.parse_io(IO_FILE.read())
+        if stat:
+            snap.parse_stat(STAT_FILE.read())
+    else:
+        if status:
+            snap.parse_status(read_proc_file(pid, "status"))
+        if io:
+            snap.parse_io(read_proc_file(pid, "io"))
+        if stat:
+            snap.parse_stat(read_proc_file(pid, "stat"))
+
+    return snap
+
+def read_field(procfile, attr):
+    """
+    Read a single Snapshot field of the current process.
+    """
+
+    snap = Snapshot()
+    snap.parse_fields(procfile.read(), {FIELD_KEYS[attr]: attr})
+    return getattr(snap, attr)
 
 def vm():
     """
     Virtual memory size.
     """
 
-    return get_vm_data("VmSize:")
+    return read_field(STATUS_FILE, "vm")
 
 def rss():
     """
     Resident set size.
     """
 
-    return get_vm_data("VmRSS:")
+    return read_field(STATUS_FILE, "rss")
 
 def max_vm():
     """
     Max virtual memory usage.
     """
 
-    return get_vm_data("VmPeak:")
+    return read_field(STATUS_FILE, "max_vm")
 
 def max_rss():
     """
     Max resident set size.
     """
 
-    return get_vm_data("VmHWM:")
+    return max(read_field(STATUS_FILE, "max_rss"), reset_peak())
 
-def read_proc_counter(fname, key):
+# Writing 5 to it resets the peak rss of the process; Linux 4.0+
+CLEAR_REFS = "/proc/self/clear_refs"
+
+# Peak rss before the last reset, per pid, and of the running sections
+PEAK_LOCK = threading.Lock()
+PEAK_RESET = {}
+SECTION_PEAKS = []
+
+def reset_peak():
     """
-    Read a single value from a proc file.
+    Return the peak rss of the current process before the last reset.
     """
 
-    try:
-        fobj = open(fname)
-    except IOError:
-        # non-Linux ?
-        return 0
-
-    with fobj:
-        for line in fobj:
-            if line.startswith(key):
-                try:
-                    _, w = line.split()
-                except ValueError:
-                    # Unknown format ?
-                    return 0
-
-                return int(w)
-        # Unknown key ?
-        return 0
+    return PEAK_RESET.get(getpid(), 0.0)
+
+def reset_peak_rss():
+    """
+    Reset the peak rss of the process, so a new peak can be measured.
+
+    max_rss and snapshot still return the peak over the process lifetime.
+    Returns False if not supported.
+    """
+
+    with PEAK_LOCK:
+        peak = read_field(STATUS_FILE, "max_rss")
+        pid = getpid()
+        PEAK_RESET[pid] = max(PEAK_RESET.get(pid, 0.0), peak)
+        for sect_peak in SECTION_PEAKS:
+            sect_peak[0] = max(sect_peak[0], peak)
+
+        try:
+            with open(CLEAR_REFS, "w") as fobj:
+                fobj.write("5")
+        except IOError:
+            return False
+
+    return True
 
 def vol_ctxt_switches():
     """
     Get the number of voluntary context switches.
     """
 
-    fname = "/proc/{0}/status".format(getpid())
-    key   = "voluntary_ctxt_switches"
-    return read_proc_counter(fname, key)
+    return read_field(STATUS_FILE, "vol_ctxt_switches")
 
 def nonvol_ctxt_switches():
     """
     Get the number of involuntary context switches.
     """
 
-    fname = "/proc/{0}/status".format(getpid())
-    key   = "nonvoluntary_ctxt_switches"
-    return read_proc_counter(fname, key)
+    return read_field(STATUS_FILE, "nonvol_ctxt_switches")
 
 def io_read():
     """
     Get the number of bytes read.
     """
 
-    fname = "/proc/{0}/io".format(getpid())
-    key   = "rchar"
-    return read_proc_counter(fname, key)
+    return read_field(IO_FILE, "io_read")
 
 def io_write():
     """
     Get the number of bytes written.
     """
 
-    fname = "/proc/{0}/io".format(getpid())
-    key   = "wchar"
-    return read_proc_counter(fname, key)
+    return read_field(IO_FILE, "io_write")
 
 def disk_io_read():
     """
     Get the number of bytes actually read from storage.
     """
 
-    fname = "/proc/{0}/io".format(getpid())
-    key   = "read_bytes"
-    return read_proc_counter(fname, key)
+    return read_field(IO_FILE, "disk_io_read")
 
 def disk_io_write():
     """
     Get the number of bytes actually sent to to storage for writing.
     """
 
-    fname = "/proc/{0}/io".format(getpid())
-    key   = "write_bytes"
-    return read_proc_counter(fname, key)
+    return read_field(IO_FILE, "disk_io_write")
 
-def print_stats(printfn=print):
+def cpu_times():
+    """
+    Get the user and system cpu time in seconds.
+    """
+
+    snap = snapshot(status=False, io=False)
+    return snap.utime, snap.stime
+
+def take_sample():
+    """
+    Read all the values in SAMPLE_FIELDS.
+    """
+
+    snap = snapshot()
+    return tuple(getattr(snap, f) for f in SAMPLE_FIELDS)
+
+class Sampler(pypb.abs.Close):
+    """
+    Sample the process stats in a background thread.
+
+    Every interval seconds a sample with the values in SAMPLE_FIELDS is
+    added to a ring buffer keeping the last maxlen samples. If export is
+    a filename, the samples are written to it at exit; as CSV if the name
+    ends with .csv, as JSON otherwise.
+    """
+
+    def __init__(self, interval=1.0, maxlen=3600, export=None):
+        self.interval = interval
+        self.samples = collections.deque(maxlen=maxlen)
+
+        if export is not None:
+            atexit.register(self.export, export)
+
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        """
+        Take samples till closed.
+        """
+
+        self.samples.append(take_sample())
+        while not self.done.wait(self.interval):
+            self.samples.append(take_sample())
+
+    @pypb.abs.runonce
+    def close(self):
+        self.done.set()
+        self.thread.join()
+
+    def series(self, field):
+        """
+        Return the list of (time, value) for the field.
+        """
+
+        i = SAMPLE_FIELDS.index(field)
+        return [(s[0], s[i]) for s in list(self.samples)]
+
+    def rates(self, field):
+        """
+        Return the list of (time, change per second) for the field.
+        """
+
+        series = self.series(field)
+        rates = []
+        for (t0, v0), (t1, v1) in zip(series, series[1:]):
+            if t1 > t0:
+                rates.append((t1, (v1 - v0) / (t1 - t0)))
+        return rates
+
+    def peak(self, field, rate=False):
+        """
+        Return the (time, value) where the field, or its rate, was highest.
+        """
+
+        series = self.rates(field) if rate else self.series(field)
+        if not series:
+            return None
+        return max(series, key=lambda x: x[1])
+
+    def to_csv(self, fname):
+        """
+        Write the samples to a CSV file.
+        """
+
+        with awriter.open(fname, "wb") as fobj:
+            writer = csv.writer(fobj)
+            writer.writerow(SAMPLE_FIELDS)
+            writer.writerows(list(self.samples))
+
+    def to_json(self, fname):
+        """
+        Write the samples to a JSON file as a list of objects.
+        """
+
+        samples = [dict(zip(SAMPLE_FIELDS, s)) for s in list(self.samples)]
+        with awriter.open(fname, "wb") as fobj:
+            json.dump(samples, fobj)
+
+    def export(self, fname):
+        """
+        Write the samples to a CSV or JSON file based on the extension.
+        """
+
+        if fname.endswith(".csv"):
+            self.to_csv(fname)
+        else:
+            self.to_json(fname)
+
+def children(pid):
+    """
+    Return the pids of the child processes of the process.
+    """
+
+    pids = set()
+    try:
+        tids = os.listdir("/proc/{0}/task".format(pid))
+    except OSError:
+        # non-Linux or process gone ?
+        return pids
+
+    for tid in tids:
+        fname = "/proc/{0}/task/{1}/children".format(pid, tid)
+        try:
+            with open(fname) as fobj:
+                pids.update(int(w) for w in fobj.read().split())
+        except IOError:
+            # Kernel without CONFIG_PROC_CHILDREN; scan all processes
+            return scan_children(pid)
+
+    return pids
+
+def scan_children(pid):
+    """
+    Return the pids of the child processes by scanning all of /proc.
+    """
+
+    pids = set()
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+
+        data = read_proc_file(name, "stat")
+        fields = data[data.rfind(")") + 2:].split()
+        if len(fields) > 1 and fields[1] == str(pid):
+            pids.add(int(name))
+
+    return pids
+
+def descendants(pid=None):
+    """
+    Return the pids of all the live descendants of the process.
+    """
+
+    pid = getpid() if pid is None else pid
+
+    found = set()
+    todo = [pid]
+    while todo:
+        for child in children(todo.pop()):
+            if child not in found:
+                found.add(child)
+                todo.append(child)
+
+    return found
+
+def tree_snapshots(pid=None):
+    """
+    Return a dict of pid to Snapshot for all the live descendants.
+    """
+
+    snaps = {}
+    for child in descendants(pid):
+        snap = snapshot(child)
+        # Skip processes that exited while reading
+        if snap.max_vm:
+            snaps[child] = snap
+
+    return snaps
+
+def children_usage():
+    """
+    Get the usage of the terminated and waited for descendants.
+
+    Returns a dict with cpu (seconds), max_rss (bytes, of the largest
+    child), and disk_io_read/disk_io_write (bytes).
+    """
+
+    ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "cpu"           : ru.ru_utime + ru.ru_stime,
+        "max_rss"       : ru.ru_maxrss * 1024,
+        "disk_io_read"  : ru.ru_inblock * 512,
+        "disk_io_write" : ru.ru_oublock * 512,
+    }
+
+def print_tree_stats(printfn=print, top=10):
+    """
+    Print the usage of the live and terminated descendants.
+    """
+
+    snaps = tree_snapshots()
+    live = snaps.values()
+    reaped = children_usage()
+    own = snapshot(io=False, status=False)
+
+    live_cpu = sum(s.utime + s.stime for s in live)
+    live_rss_m = sum(s.rss for s in live) / MEGA
+    live_max_rss_m = max([s.max_rss for s in live] or [0]) / MEGA
+    live_io_read_m = sum(s.io_read for s in live) / MEGA
+    live_io_write_m = sum(s.io_write for s in live) / MEGA
+    reaped_max_rss_m = reaped["max_rss"] / MEGA
+    reaped_dio_read_m = reaped["disk_io_read"] / MEGA
+    reaped_dio_write_m = reaped["disk_io_write"] / MEGA
+    tree_cpu = own.utime + own.stime + live_cpu + reaped["cpu"]
+
+    printfn("# Live descendants             : {:,d}".format(len(live)))
+    printfn("Live descendants RSS           : {:.2f} MiB".format(live_rss_m))
+    printfn("Live descendants peak RSS      : {:.2f} MiB".format(live_max_rss_m))
+    printfn("Live descendants CPU time      : {:.2f} s".format(live_cpu))
+    printfn("Live descendants IO Read       : {:.2f} MiB".format(live_io_read_m))
+    printfn("Live descendants IO Write      : {:.2f} MiB".format(live_io_write_m))
+    printfn("Reaped children CPU time       : {:.2f} s".format(reaped["cpu"]))
+    printfn("Reaped children peak RSS       : {:.2f} MiB".format(reaped_max_rss_m))
+    printfn("Reaped children Disk IO Read   : {:.2f} MiB".format(reaped_dio_read_m))
+    printfn("Reaped children Disk IO Write  : {:.2f} MiB".format(reaped_dio_write_m))
+    printfn("Process tree CPU time          : {:.2f} s".format(tree_cpu))
+
+    if not snaps:
+        return
+
+    xss = [["PID", "Peak RSS (MiB)", "RSS (MiB)", "CPU (s)",
+            "IO Read (MiB)", "IO Write (MiB)"]]
+    peaks = sorted(snaps.iteritems(), key=lambda x: -x[1].max_rss)
+    for pid, snap in peaks[:top]:
+        xss.append([str(pid),
+                    "{:.2f}".format(snap.max_rss / MEGA),
+                    "{:.2f}".format(snap.rss / MEGA),
+                    "{:.2f}".format(snap.utime + snap.stime),
+                    "{:.2f}".format(snap.io_read / MEGA),
+                    "{:.2f}".format(snap.io_write / MEGA)])
+
+    aligns = dict((i, ">") for i in xrange(len(xss[0])))
+    printfn("Live descendants by peak RSS:")
+    printfn(simple_fmt_tab(xss, aligns=aligns))
+
+def tracemalloc_sites(limit, nframes):
+    """
+    Return the top allocation sites as a list of (site, bytes, count).
+    """
+
+    key = "lineno" if nframes == 1 else "traceback"
+    stats = tracemalloc.take_snapshot().statistics(key)
+
+    sites = []
+    for stat in stats[:limit]:
+        site = " <- ".join("{}:{}".format(f.filename, f.lineno)
+                           for f in stat.traceback)
+        sites.append((site, stat.size, stat.count))
+    return sites
+
+def gc_types(limit, sample):
+    """
+    Return the types using the most memory as a list of (type, bytes, count).
+
+    Only every sample-th object tracked by the garbage collector is
+    measured, or fewer to measure at most GC_MAX_SAMPLES objects, and the
+    totals are scaled up accordingly.
+
+    NOTE: Only containers are tracked by the garbage collector; str,
+          bytearray, numbers, numpy arrays and memory allocated by C code
+          are not seen. The size of a container doesn't include the
+          objects it contains.
+    """
+
+    objs = gc.get_objects()
+    stride = max(sample, len(objs) // GC_MAX_SAMPLES)
+
+    sizes = collections.defaultdict(int)
+    counts = collections.defaultdict(int)
+    for obj in itertools.islice(objs, 0, None, stride):
+        name = type(obj).__name__
+        sizes[name] += sys.getsizeof(obj, 0)
+        counts[name] += 1
+    del objs
+
+    top = sorted(sizes.iteritems(), key=lambda x: -x[1])[:limit]
+    return [(name, size * stride, counts[name] * stride) for name, size in top]
+
+class AllocTracker(pypb.abs.Close):
+    """
+    Find the top allocation sites at peak RSS and at exit.
+
+    Uses tracemalloc where available, keeping nframes frames per
+    allocation. Otherwise, as on Python 2, there are no allocation sites;
+    the objects tracked by the garbage collector are sampled and reported
+    by type instead; see gc_types for what is missed.
+
+    A background thread checks the rss every interval seconds and records
+    the top limit sites whenever the rss grew by more than min_growth bytes
+    over the last recorded peak. So the overhead is bounded by interval,
+    min_growth, nframes and sample.
+    """
+
+    def __init__(self, limit=10, interval=1.0, min_growth=64 * MEGA,
+                 nframes=1, sample=10):
+        self.limit = limit
+        self.interval = interval
+        self.min_growth = min_growth
+        self.nframes = nframes
+        self.sample = sample
+
+        self.peak_rss = 0.0
+        self.peak_sites = []
+
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start(nframes)
+
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def sites(self):
+        """
+        Return the current top allocation sites.
+        """
+
+        if tracemalloc is not None:
+            return tracemalloc_sites(self.limit, self.nframes)
+        return gc_types(self.limit, self.sample)
+
+    def _run(self):
+        """
+        Record the top sites at every new rss peak till closed.
+        """
+
+        while not self.done.wait(self.interval):
+            cur_rss = rss()
+            if cur_rss > self.peak_rss + self.min_growth:
+                self.peak_sites = self.sites()
+                self.peak_rss = cur_rss
+
+    @pypb.abs.runonce
+    def close(self):
+        self.done.set()
+        self.thread.join()
+
+    def report(self, printfn=print):
+        """
+        Print the top allocation sites at peak rss and now.
+        """
+
+        if tracemalloc is not None:
+            what, column = "allocation sites", "Site"
+        else:
+            what, column = "types of gc tracked objects (sampled)", "Type"
+
+        def table(sites):
+            """
+            Format the sites as a table.
+            """
+
+            xss = [[column, "Size (MiB)", "Count"]]
+            for site, size, count in sites:
+                xss.append([site, "{:.2f}".format(size / MEGA),
+                            "{:,d}".format(count)])
+            return simple_fmt_tab(xss, aligns={1: ">", 2: ">"})
+
+        if self.peak_sites:
+            msg = "Top {} at peak RSS ({:.2f} MiB):"
+            printfn(msg.format(what, self.peak_rss / MEGA))
+            printfn(table(self.peak_sites))
+
+        printfn("Top {} at exit:".format(what))
+        printfn(table(self.sites()))
+        if tracemalloc is None:
+            printfn("NOTE: str, bytearray and other untracked objects "
+                    "are not included")
+
+# Tracker started by track_allocations
+ALLOC_TRACKER = None
+
+def track_allocations(**kwargs):
+    """
+    Start tracking allocations; print_stats reports the top sites.
+
+    The kwargs are passed to AllocTracker.
+    """
+
+    global ALLOC_TRACKER # pylint: disable=global-statement
+
+    if ALLOC_TRACKER is None:
+        ALLOC_TRACKER = AllocTracker(**kwargs)
+    return ALLOC_TRACKER
+
+# Aggregated stats of the profiled sections
+SECTIONS = {}
+SECTIONS_LOCK = threading.Lock()
+
+# Names of the sections being run by the current thread
+SECTION_STACK = threading.local()
+
+def cpu_time():
+    """
+    Get the user + system cpu time in seconds at full resolution.
+    """
+
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    return ru.ru_utime + ru.ru_stime
+
+@contextmanager
+def section(name):
+    """
+    Profile the resource usage of a named section of code.
+
+    Stats are aggregated per section over all the calls. Sections nested
+    inside others are recorded separately under the names of all the
+    enclosing sections joined by SECTION_SEP. The counters are process
+    wide, so they include the work of other threads during the section.
+
+    The peak rss is measured by resetting the process peak at the start
+    of the section; without kernel support (Linux 4.0+) it is the process
+    peak at the end of the section.
+    """
+
+    stack = SECTION_STACK.__dict__.setdefault("names", [])
+    stack.append(name)
+    path = SECTION_SEP.join(stack)
+
+    # Reset the peak after keeping it for the enclosing sections
+    reset_peak_rss()
+    peak = [0.0]
+    with PEAK_LOCK:
+        SECTION_PEAKS.append(peak)
+
+    start = snapshot(stat=False)
+    start_cpu = cpu_time()
+    try:
+        yield
+    finally:
+        end_cpu = cpu_time()
+        end = snapshot(stat=False)
+        stack.pop()
+
+        with PEAK_LOCK:
+            SECTION_PEAKS.remove(peak)
+            peak_rss = max(peak[0], read_field(STATUS_FILE, "max_rss"))
+
+        with SECTIONS_LOCK:
+            stats = SECTIONS.get(path)
+            if stats is None:
+                stats = dict.fromkeys(["calls", "wall", "cpu", "rss_delta",
+                                       "peak_rss", "io_read", "io_write",
+                                       "ctxt_switches"], 0)
+                SECTIONS[path] = stats
+
+            stats["calls"]     += 1
+            stats["wall"]      += end.time - start.time
+            stats["cpu"]       += end_cpu - start_cpu
+            stats["rss_delta"] += end.rss - start.rss
+            stats["peak_rss"]   = max(stats["peak_rss"], peak_rss)
+            stats["io_read"]   += end.io_read - start.io_read
+            stats["io_write"]  += end.io_write - start.io_write
+            stats["ctxt_switches"] += (end.vol_ctxt_switches
+                                       + end.nonvol_ctxt_switches
+                                       - start.vol_ctxt_switches
+                                       - start.nonvol_ctxt_switches)
+
+def profile(name=None):
+    """
+    Decorator profiling every call of the function as a section.
+
+    The section name defaults to the function name.
+    """
+
+    def decorator_fn(origfn): # pylint: disable=missing-docstring
+        secname = origfn.__name__ if name is None else name
+
+        @wraps(origfn)
+        def newfn(*args, **kwargs):
+            """
+            Run the original function inside the section.
+            """
+
+            with section(secname):
+                return origfn(*args, **kwargs)
+
+        return newfn
+
+    return decorator_fn
+
+def section_stats():
+    """
+    Return a copy of the aggregated section stats.
+
+    Peak RSS is the peak RSS during the section; see section.
+    """
+
+    with SECTIONS_LOCK:
+        return dict((k, dict(v)) for k, v in SECTIONS.iteritems())
+
+def section_table():
+    """
+    Return the section stats formatted as a table.
+    """
+
+    xss = [["Section", "Calls", "Wall (s)", "CPU (s)", "RSS Delta (MiB)",
+            "Peak RSS (MiB)", "IO Read (MiB)", "IO Write (MiB)",
+            "Ctxt Switches"]]
+    for path, stats in sorted(section_stats().iteritems()):
+        xss.append([path, "{:,d}".format(stats["calls"]),
+                    "{:.3f}".format(stats["wall"]),
+                    "{:.3f}".format(stats["cpu"]),
+                    "{:.2f}".format(stats["rss_delta"] / MEGA),
+                    "{:.2f}".format(stats["peak_rss"] / MEGA),
+                    "{:.2f}".format(stats["io_read"] / MEGA),
+                    "{:.2f}".format(stats["io_write"] / MEGA),
+                    "{:,d}".format(stats["ctxt_switches"])])
+
+    aligns = dict((i, ">") for i in xrange(1, len(xss[0])))
+    return simple_fmt_tab(xss, aligns=aligns)
+
+def print_stats(printfn=print, tree=False):
     """
     Print runtime and memory usage.
+
+    If tree is True, also print the usage of the descendant processes.
     """
 
     now = datetime.utcnow()
+    snap = snapshot(stat=False)
 
     rt            = now - START
-    max_vm_m      = max_vm() / MEGA
-    max_rss_m     = max_rss() / MEGA
-    io_read_m     = io_read() / MEGA
-    io_write_m    = io_write() / MEGA
-    dio_read_m    = disk_io_read() / MEGA
-    dio_write_m   = disk_io_write() / MEGA
-    vol_switch  = vol_ctxt_switches()
-    nvol_switch = nonvol_ctxt_switches()
+    max_vm_m      = snap.max_vm / MEGA
+    max_rss_m     = snap.max_rss / MEGA
+    io_read_m     = snap.io_read / MEGA
+    io_write_m    = snap.io_write / MEGA
+    dio_read_m    = snap.disk_io_read / MEGA
+    dio_write_m   = snap.disk_io_write / MEGA
+    vol_switch  = snap.vol_ctxt_switches
+    nvol_switch = snap.nonvol_ctxt_switches
 
     printfn("Total running time             : {}".format(rt))
     printfn("Peak virtual memory size       : {:.2f} MiB".format(max_vm_m))
@@ -182,3 +951,13 @@ def print_stats(printfn=print):
     printfn("Disk IO Write                  : {:.2f} MiB".format(dio_write_m))
     printfn("# Voluntary context switch     : {:,d}".format(vol_switch))
     printfn("# Non-Voluntary context switch : {:,d}".format(nvol_switch))
+
+    if tree:
+        print_tree_stats(printfn)
+
+    if SECTIONS:
+        printfn("Profiled sections:")
+        printfn(section_table())
+
+    if ALLOC_TRACKER is not None:
+        ALLOC_TRACKER.report(printfn)
@@ -0,0 +1,204 @@
+"""
+Locks in shared memory for processes on the same host.
+
+These avoid the fcntl syscalls of pypb.flock on the fast path and have
+the same acquire / release / lock(lock_type, timeout) API, so the lock
+can be chosen per use site with make_lock. Use pypb.flock for locking
+across hosts or over NFS.
+
+NOTE: The locks must be created before forking the processes using them;
+      eg. before spawning the ProcessFarm workers.
+"""
+
+import time
+import mmap
+import struct
+import multiprocessing as mp
+from contextlib import contextmanager
+
+import pypb.flock as flock
+
+# Format of the reader count in the shared memory
+COUNT_FMT = "l"
+
+def deadline_left(deadline):
+    """
+    Return the seconds left till deadline; None means no deadline.
+    """
+
+    if deadline is None:
+        return None
+    return max(deadline - time.time(), 0)
+
+def sem_acquire(sem, deadline):
+    """
+    Acquire the semaphore before the deadline.
+    """
+
+    if not sem.acquire(True, deadline_left(deadline)):
+        raise flock.LockTimeout("Lock timed out")
+
+def check_lock_type(lock_type):
+    """
+    Make sure the lock type is valid.
+    """
+
+    if lock_type not in flock.OPERATIONS:
+        raise ValueError("Invalid lock_type: '%s'" % lock_type)
+
+class ShmMutex(object):
+    """
+    Mutex shared between processes; shared locks are exclusive too.
+    """
+
+    def __init__(self):
+        self.sem = mp.Semaphore(1)
+
+    def acquire(self, lock_type="exclusive", timeout=None):
+        """
+        Acquire the mutex; raise LockTimeout after timeout seconds.
+        """
+
+        check_lock_type(lock_type)
+
+        if timeout is None:
+            self.sem.acquire()
+        elif not self.sem.acquire(True, timeout):
+            raise flock.LockTimeout("Lock timed out")
+
+    def release(self):
+        """
+        Release the mutex.
+        """
+
+        self.sem.release()
+
+    @contextmanager
+    def lock(self, lock_type="exclusive", timeout=None):
+        """
+        Hold the mutex for the with block.
+        """
+
+        self.acquire(lock_type, timeout)
+        try:
+            yield None
+        finally:
+            self.release()
+
+class ShmRWLock(object):
+    """
+    Reader-writer lock shared between processes.
+
+    The number of readers is kept in an anonymous shared mmap. Waiting
+    writers block new readers, so writers don't starve.
+    """
+
+    def __init__(self):
+        self.shm = mmap.mmap(-1, struct.calcsize(COUNT_FMT))
+
+        # Guards the reader count
+        self.mutex = mp.Semaphore(1)
+        # Held by the writer or the readers as a group
+        self.wlock = mp.Semaphore(1)
+        # Held by a waiting writer to stop new readers
+        self.turnstile = mp.Semaphore(1)
+
+        # Release needs to know what was acquired
+        self.lock_types = []
+
+    def _add_readers(self, delta):
+        """
+        Add delta to the reader count; return the new count.
+        """
+
+        count = struct.unpack_from(COUNT_FMT, self.shm)[0] + delta
+        struct.pack_into(COUNT_FMT, self.shm, 0, count)
+        return count
+
+    def _acquire_shared(self, deadline):
+        """
+        Acquire the lock as a reader.
+        """
+
+        sem_acquire(self.turnstile, deadline)
+        self.turnstile.release()
+
+        sem_acquire(self.mutex, deadline)
+        try:
+            if self._add_readers(1) == 1:
+                try:
+                    sem_acquire(self.wlock, deadline)
+                except flock.LockTimeout:
+                    self._add_readers(-1)
+                    raise
+        finally:
+            self.mutex.release()
+
+    def _acquire_exclusive(self, deadline):
+        """
+        Acquire the lock as the writer.
+        """
+
+        sem_acquire(self.turnstile, deadline)
+        try:
+            sem_acquire(self.wlock, deadline)
+        finally:
+            self.turnstile.release()
+
+    def acquire(self, lock_type="exclusive", timeout=None):
+        """
+        Acquire the lock; raise LockTimeout after timeout seconds.
+        """
+
+        check_lock_type(lock_type)
+        deadline = None if timeout is None else time.time() + timeout
+
+        if lock_type == "shared":
+            self._acquire_shared(deadline)
+        else:
+            self._acquire_exclusive(deadline)
+
+        self.lock_types.append(lock_type)
+
+    def release(self):
+        """
+        Release the lock.
+        """
+
+        lock_type = self.lock_types.pop()
+
+        if lock_type == "shared":
+            with self.mutex:
+                if self._add_readers(-1) == 0:
+                    self.wlock.release()
+        else:
+            self.wlock.release()
+
+    @contextmanager
+    def lock(self, lock_type="exclusive", timeout=None):
+        """
+        Hold the lock for the with block.
+        """
+
+        self.acquire(lock_type, timeout)
+        try:
+            yield None
+        finally:
+            self.release()
+
+def make_lock(kind, fname=None):
+    """
+    Return a lock of the given kind.
+
+    kind - One of "flock", "mutex" and "rwlock".
+           fname is the lock file for "flock".
+    """
+
+    if kind == "flock":
+        return flock.get_lock(fname)
+    elif kind == "mutex":
+        return ShmMutex()
+    elif kind == "rwlock":
+        return ShmRWLock()
+    else:
+        raise ValueError("Invalid lock kind: '%s'" % kind)
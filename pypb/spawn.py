@@ -2,19 +2,59 @@
 Simple interface to python multi-tasking.
 """
 
+from __future__ import division, print_function
+
+import os
 import sys
 import abc
 import time
+import math
+import select
+import signal
+import threading
+import traceback
+import Queue
+import collections
+import functools
 import multiprocessing as mp
 
 import gevent
+import gevent.pool as gp
 import gevent.queue as gq
 import setproctitle as spt
 
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
 import pypb.abs
+import pypb.pstat as pstat
+from pypb.timelimit import timelimit
+from pypb.ptable import simple_fmt_tab
 
 cpu_count = mp.cpu_count
 
+# Priority class of tasks spawned without one; lower runs first
+DEFAULT_PRIORITY = 0
+
+# Number of finished tasks needed before speculating on stragglers
+SPECULATE_MIN_DONE = 5
+
+# Seconds between memory checks of a task with a memory ceiling
+MEMCHECK_INTERVAL = 0.5
+
+# Seconds a timed out task gets to die before it is killed by the parent
+TIMEOUT_GRACE = 5
+
+# Counters recorded for every task when accounting is enabled
+TASK_COUNTERS = ["wall", "cpu", "io_read", "io_write",
+                 "disk_io_read", "disk_io_write",
+                 "vol_ctxt_switches", "nonvol_ctxt_switches"]
+
 class TaskFarm(pypb.abs.Close):
     """
     Base class for task farms.
@@ -24,12 +64,24 @@ class TaskFarm(pypb.abs.Close):
 
     def __init__(self):
         self.procs = set()
+        self.failed = []
 
     @pypb.abs.runonce
     def close(self):
         self.kill_all()
         self.join_all()
 
+    def print_failed(self, printfn=print):
+        """
+        Print the tasks that failed for good.
+        """
+
+        for info in self.failed:
+            msg = "Task {} : {} : failed after {} attempt(s) : {}"
+            msg = msg.format(info["tasknum"], info["func"].__name__,
+                             info["attempt"], info["error"])
+            printfn(msg)
+
     def _join_all_any(self, procs, return_on_any):
         """
         Join processes.
@@ -51,6 +103,13 @@ class TaskFarm(pypb.abs.Close):
                 self._join(p)
                 self.procs.discard(p)
                 procs.discard(p)
+
+                # Wait for the retry instead, if any
+                newp = self._retry(p)
+                if newp is not None:
+                    procs.add(newp)
+                    continue
+
                 count_joined += 1
 
             if return_on_any and count_joined > 0:
@@ -100,28 +159,124 @@ class TaskFarm(pypb.abs.Close):
     def _is_alive(self, proc):
         pass
 
-def proc_init_run(procnum, func, args, kwargs):
+    def _retry(self, proc): # pylint: disable=unused-argument,no-self-use
+        """
+        Return a replacement for the joined process if it is retried.
+        """
+
+        return None
+
+def call_timelimit(func, args, kwargs, timeout):
+    """
+    Call the function, raising TimeoutException after timeout seconds.
+    """
+
+    if timeout is None:
+        return func(*args, **kwargs)
+
+    with timelimit(int(math.ceil(timeout))):
+        return func(*args, **kwargs)
+
+def task_counters():
+    """
+    Read the current resource counters of the process.
+    """
+
+    snap = pstat.snapshot(stat=False)
+    return {
+        "wall"                 : snap.time,
+        "cpu"                  : sum(os.times()[:2]),
+        "io_read"              : snap.io_read,
+        "io_write"             : snap.io_write,
+        "disk_io_read"         : snap.disk_io_read,
+        "disk_io_write"        : snap.disk_io_write,
+        "vol_ctxt_switches"    : snap.vol_ctxt_switches,
+        "nonvol_ctxt_switches" : snap.nonvol_ctxt_switches,
+    }
+
+def memory_watchdog(max_rss):
+    """
+    Kill the current process if its rss goes above max_rss bytes.
+    """
+
+    while True:
+        rss = pstat.rss()
+        if rss > max_rss:
+            msg = "{} : RSS {:.2f} MiB over limit {:.2f} MiB; killing\n"
+            msg = msg.format(os.getpid(), rss / pstat.MEGA, max_rss / pstat.MEGA)
+            sys.stderr.write(msg)
+            sys.stderr.flush()
+
+            os.kill(os.getpid(), signal.SIGKILL)
+
+        time.sleep(MEMCHECK_INTERVAL)
+
+def proc_init_run(procnum, func, args, kwargs,
+                  statq=None, max_rss=None, timeout=None):
     """
     Set the process title and run.
+
+    If statq is given, the resource usage of the task is put on it.
+    If max_rss is given, the process is killed if its rss goes above it.
+    If timeout is given, TimeoutException is raised after timeout seconds.
     """
 
     title = spt.getproctitle()
     title = "{} : {} : {}".format(title, procnum, func.__name__)
     spt.setproctitle(title)
 
-    return func(*args, **kwargs)
+    if max_rss is not None:
+        watchdog = threading.Thread(target=memory_watchdog, args=(max_rss,))
+        watchdog.daemon = True
+        watchdog.start()
+
+    if statq is None:
+        return call_timelimit(func, args, kwargs, timeout)
+
+    start = task_counters()
+    try:
+        return call_timelimit(func, args, kwargs, timeout)
+    finally:
+        end = task_counters()
+
+        stats = dict((k, end[k] - start[k]) for k in TASK_COUNTERS)
+        stats["procnum"] = procnum
+        stats["func"] = func.__name__
+        stats["max_rss"] = pstat.max_rss()
+        stats["killed"] = False
+        statq.put(stats)
 
 class ProcessFarm(TaskFarm):
     """
     Spawn processes.
+
+    If account is True, the resource usage of every task is recorded in
+    task_stats. If max_rss is given, tasks whose rss goes above max_rss
+    bytes are killed.
+
+    If timeout is given, tasks running longer than timeout seconds fail;
+    tasks that don't stop on their own are killed TIMEOUT_GRACE seconds
+    later. Failed tasks (non-zero exit code) are run again up to retries
+    times. Tasks that failed for good, or were killed, are recorded in
+    failed.
     """
 
-    def __init__(self, max_procs=sys.maxsize):
+    def __init__(self, max_procs=sys.maxsize, account=False, max_rss=None,
+                 timeout=None, retries=0):
         super(ProcessFarm, self).__init__()
 
         self.procnum = 0
         self.max_procs = max_procs
 
+        self.max_rss = max_rss
+        self.statq = mp.Queue() if account else None
+        self.task_stats = []
+        self.proc_info = {}
+
+        self.timeout = timeout
+        self.retries = retries
+        self.killed = set()
+
     def spawn(self, func, *args, **kwargs):
         """
         Spawn a new process.
@@ -136,24 +291,161 @@ class ProcessFarm(TaskFarm):
 
         self.procnum += 1
 
-        pargs = (self.procnum, func, args, kwargs)
+        return self._start(self.procnum, func, args, kwargs, 1)
+
+    def _start(self, procnum, func, args, kwargs, attempt):
+        """
+        Start the process running the task.
+        """
+
+        pargs = (procnum, func, args, kwargs,
+                 self.statq, self.max_rss, self.timeout)
         proc = mp.Process(target=proc_init_run, args=pargs)
         proc.start()
         self.procs.add(proc)
 
+        self.proc_info[proc] = {
+            "tasknum" : procnum,
+            "procnum" : procnum,
+            "func"    : func,
+            "args"    : args,
+            "kwargs"  : kwargs,
+            "attempt" : attempt,
+            "start"   : time.time(),
+        }
+
         return proc
 
     def make_queue(self, maxsize=0):
         return mp.Queue(maxsize)
 
+    def _collect_stats(self):
+        """
+        Collect the task stats sent by the finished processes.
+        """
+
+        while True:
+            try:
+                self.task_stats.append(self.statq.get_nowait())
+            except Queue.Empty:
+                break
+
+    def stats_summary(self):
+        """
+        Return the task stats aggregated per function name.
+
+        Counters are summed up over the tasks, except max_rss which is the
+        maximum over the tasks.
+        """
+
+        self._collect_stats()
+
+        summary = {}
+        for stats in self.task_stats:
+            agg = summary.get(stats["func"])
+            if agg is None:
+                agg = dict.fromkeys(TASK_COUNTERS, 0)
+                agg.update(count=0, killed=0, max_rss=0)
+                summary[stats["func"]] = agg
+
+            agg["count"] += 1
+            agg["killed"] += int(stats["killed"])
+            agg["max_rss"] = max(agg["max_rss"], stats["max_rss"])
+            for k in TASK_COUNTERS:
+                agg[k] += stats[k]
+
+        return summary
+
+    def print_stats(self, printfn=print):
+        """
+        Print the task stats aggregated per function name.
+        """
+
+        M = pstat.MEGA
+
+        xss = [["Function", "Tasks", "Killed", "Wall (s)", "CPU (s)",
+                "Peak RSS (MiB)", "IO Read (MiB)", "IO Write (MiB)",
+                "Disk Read (MiB)", "Disk Write (MiB)", "Vol CS", "Non-Vol CS"]]
+        for func, agg in sorted(self.stats_summary().iteritems()):
+            xss.append([func, agg["count"], agg["killed"],
+                        "{:.2f}".format(agg["wall"]),
+                        "{:.2f}".format(agg["cpu"]),
+                        "{:.2f}".format(agg["max_rss"] / M),
+                        "{:.2f}".format(agg["io_read"] / M),
+                        "{:.2f}".format(agg["io_write"] / M),
+                        "{:.2f}".format(agg["disk_io_read"] / M),
+                        "{:.2f}".format(agg["disk_io_write"] / M),
+                        "{:,d}".format(agg["vol_ctxt_switches"]),
+                        "{:,d}".format(agg["nonvol_ctxt_switches"])])
+
+        aligns = dict((i, ">") for i in xrange(1, len(xss[0])))
+        printfn(simple_fmt_tab(xss, aligns=aligns))
+
     def _kill(self, proc):
+        self.killed.add(proc)
         return proc.terminate()
 
     def _join(self, proc):
-        return proc.join()
+        # Finishing tasks block on a full stats pipe till it is drained
+        while True:
+            if self.statq is not None:
+                self._collect_stats()
+            ret = proc.join(0.1)
+            if proc.exitcode is not None:
+                break
+        if self.statq is not None:
+            self._collect_stats()
+
+        info = self.proc_info[proc]
+        if self.statq is not None and proc.exitcode == -signal.SIGKILL:
+            # Killed tasks never get to send their stats
+            stats = dict.fromkeys(TASK_COUNTERS, 0)
+            stats.update(procnum=info["procnum"], func=info["func"].__name__,
+                         max_rss=0, killed=True)
+            self.task_stats.append(stats)
+
+        return ret
+
+    def _retry(self, proc):
+        info = self.proc_info.pop(proc)
+        killed = proc in self.killed
+        self.killed.discard(proc)
+
+        if proc.exitcode == 0:
+            return None
+
+        if not killed and info["attempt"] <= self.retries:
+            return self._start(info["procnum"], info["func"], info["args"],
+                               info["kwargs"], info["attempt"] + 1)
+
+        if killed:
+            error = "killed"
+        elif proc.exitcode < 0:
+            error = "died with signal {}".format(-proc.exitcode)
+        else:
+            error = "exited with code {}".format(proc.exitcode)
+
+        info["error"] = error
+        self.failed.append(info)
+        return None
 
     def _is_alive(self, proc):
-        return proc.is_alive()
+        # Drain the stats, or tasks can't exit while the pipe is full
+        if self.statq is not None:
+            self._collect_stats()
+
+        if not proc.is_alive():
+            return False
+
+        # Kill tasks which ignore their time limit
+        if self.timeout is not None:
+            runtime = time.time() - self.proc_info[proc]["start"]
+            if runtime > self.timeout + 2 * TIMEOUT_GRACE:
+                os.kill(proc.pid, signal.SIGKILL)
+            elif runtime > self.timeout + TIMEOUT_GRACE:
+                proc.terminate()
+
+        return True
 
 class GreenletFarm(TaskFarm):
     """
@@ -186,4 +478,956 @@ class GreenletFarm(TaskFarm):
     def _is_alive(self, proc):
         return not bool(proc.ready())
 
+class Task(object):
+    """
+    Handle for a task running in a worker process.
+
+    Mimics the result part of the gevent Greenlet interface.
+    """
+
+    def __init__(self, tasknum, name):
+        self.tasknum = tasknum
+        self.name = name
+
+        self.value = None
+        self.exception = None
+        self._ready = False
+        self._successful = False
+
+    def __repr__(self):
+        return "<Task {} : {}>".format(self.tasknum, self.name)
+
+    def set_result(self, successful, value):
+        """
+        Mark the task as finished.
+
+        If not successful the value is the formatted exception.
+        """
+
+        if self._ready:
+            return
+
+        self._ready = True
+        self._successful = successful
+        if successful:
+            self.value = value
+        else:
+            self.exception = value
+
+    def ready(self):
+        """
+        Return True if the task has finished.
+        """
+
+        return self._ready
+
+    def successful(self):
+        """
+        Return True if the task has finished without raising an exception.
+        """
+
+        return self._successful
+
+    def get(self):
+        """
+        Return the result of the finished task.
+        """
+
+        if not self._ready:
+            raise ValueError("Task not finished: {!r}".format(self))
+        if not self._successful:
+            raise RuntimeError("Task failed: {!r}\n{}".format(self,
+                                                              self.exception))
+        return self.value
+
+def run_task(func, args, kwargs, timeout=None):
+    """
+    Run the function and return (successful, value).
+    """
+
+    try:
+        return True, call_timelimit(func, args, kwargs, timeout)
+    except Exception: # pylint: disable=broad-except
+        return False, traceback.format_exc()
+
+class WorkerFarm(TaskFarm):
+    """
+    Base class for farms running Task objects in worker processes.
+
+    Keeps the tasks not finished yet and their entries, and the failure
+    count of every task. Failed tasks are put back with _requeue up to
+    retries times; tasks that failed for good are recorded in failed.
+    """
+
+    def __init__(self, retries=0):
+        super(WorkerFarm, self).__init__()
+
+        self.retries = retries
+        self.failures = collections.defaultdict(int)
+
+        self.tasknum = 0
+        self.tasks = {}
+        self.entries = {}
+
+    def _new_task(self, func, args, kwargs):
+        """
+        Return a new Task for the function call.
+        """
+
+        self.tasknum += 1
+
+        task = Task(self.tasknum, func.__name__)
+        self.tasks[task.tasknum] = task
+        self.entries[task.tasknum] = (func, args, kwargs)
+        self.procs.add(task)
+
+        return task
+
+    def _finish(self, task, successful, value):
+        """
+        Set the task result and forget about the task.
+        """
+
+        task.set_result(successful, value)
+        self.tasks.pop(task.tasknum, None)
+        self.entries.pop(task.tasknum, None)
+        self.failures.pop(task.tasknum, None)
+
+    def _fail(self, task, error):
+        """
+        Put the failed task back or give up on it.
+        """
+
+        self.failures[task.tasknum] += 1
+        if self.failures[task.tasknum] <= self.retries:
+            self._requeue(task)
+            return
+
+        func, args, kwargs = self.entries[task.tasknum]
+        info = {
+            "tasknum" : task.tasknum,
+            "func"    : func,
+            "args"    : args,
+            "kwargs"  : kwargs,
+            "attempt" : self.failures[task.tasknum],
+            "error"   : error,
+        }
+        self.failed.append(self._failed_info(task, info))
+        self._finish(task, False, error)
+
+    def _failed_info(self, task, info): # pylint: disable=unused-argument,no-self-use
+        """
+        Return the info recorded in failed for the task.
+        """
+
+        return info
+
+    @abc.abstractmethod
+    def _requeue(self, task):
+        pass
+
+def hybrid_worker_run(procnum, max_greenlets, taskq, conn):
+    """
+    Run tasks from the queue in a pool of greenlets.
+
+    Results are sent back on the worker's own pipe.
+    """
+
+    title = spt.getproctitle()
+    title = "{} : {} : hybrid".format(title, procnum)
+    spt.setproctitle(title)
+
+    def greenlet_run(tasknum, func, args, kwargs):
+        """
+        Run one task and send back the result.
+        """
+
+        successful, value = run_task(func, args, kwargs)
+        conn.send((tasknum, successful, value))
+
+    pool = gp.Pool(max_greenlets)
+    threadpool = gevent.get_hub().threadpool
+    while True:
+        pool.wait_available()
+
+        # Wait in a thread so that running greenlets are not blocked
+        task = threadpool.apply(taskq.get)
+
+        # Then take what is already queued without the thread round trip
+        while task is not None:
+            pool.spawn(greenlet_run, *task)
+            if pool.full():
+                break
+            try:
+                task = taskq.get_nowait()
+            except Queue.Empty:
+                break
+
+        if task is None:
+            break
+
+    pool.join()
+
+class HybridFarm(WorkerFarm):
+    """
+    Spawn greenlets spread over a fixed number of processes.
+
+    Every worker has its own task and result queues and is given at most
+    max_greenlets tasks at a time; the rest wait in the parent. Workers
+    that die are restarted. Their unfinished tasks are run again up to
+    retries times; tasks that failed for good are recorded in failed.
+    """
+
+    def __init__(self, num_procs=None, max_greenlets=1000, retries=0):
+        super(HybridFarm, self).__init__(retries)
+
+        if num_procs is None:
+            num_procs = cpu_count()
+
+        self.num_procs = num_procs
+        self.max_greenlets = max_greenlets
+
+        self.pending = collections.deque()
+        self.finished = []
+
+        self.assigned = [None] * num_procs
+        self.taskqs = [None] * num_procs
+        self.conns = [None] * num_procs
+        self.workers = [None] * num_procs
+        for workerid in xrange(num_procs):
+            self._start_worker(workerid)
+
+    def _start_worker(self, workerid):
+        """
+        Start a fresh worker process in the given slot.
+        """
+
+        taskq = mp.Queue()
+        reader, writer = mp.Pipe(duplex=False)
+        pargs = (workerid + 1, self.max_greenlets, taskq, writer)
+        proc = mp.Process(target=hybrid_worker_run, args=pargs)
+        proc.start()
+
+        # Only the worker writes; reads then fail once it is gone
+        writer.close()
+
+        self.assigned[workerid] = set()
+        self.taskqs[workerid] = taskq
+        self.conns[workerid] = reader
+        self.workers[workerid] = proc
+
+    @pypb.abs.runonce
+    def close(self):
+        super(HybridFarm, self).kill_all()
+        self.join_all()
+
+        for proc in self.workers:
+            proc.terminate()
+            proc.join()
+
+    def spawn(self, func, *args, **kwargs):
+        """
+        Spawn a new greenlet in one of the worker processes.
+
+        func       - The func to be run in the new greenlet.
+        *args      - The positional arguments for _func_
+        **kwargs   - The keyword arguments for _func_
+
+        Returns a Task object which can be used to get the result.
+        """
+
+        task = self._new_task(func, args, kwargs)
+        self.pending.append(task)
+        self._dispatch()
+
+        return task
+
+    def make_queue(self, maxsize=0):
+        return mp.Queue(maxsize)
+
+    def kill_all(self):
+        """
+        Kill any tasks still running by restarting the worker processes.
+        """
+
+        super(HybridFarm, self).kill_all()
+
+        for workerid, proc in enumerate(self.workers):
+            proc.terminate()
+            proc.join()
+            self.conns[workerid].close()
+            self._start_worker(workerid)
+
+    def _dispatch(self):
+        """
+        Send pending tasks to the least loaded workers with free slots.
+        """
+
+        while self.pending:
+            workerid = min(xrange(self.num_procs),
+                           key=lambda w: len(self.assigned[w]))
+            if len(self.assigned[workerid]) >= self.max_greenlets:
+                break
+
+            task = self.pending.popleft()
+            func, args, kwargs = self.entries[task.tasknum]
+            self.taskqs[workerid].put((task.tasknum, func, args, kwargs))
+            self.assigned[workerid].add(task.tasknum)
+
+    def _finish(self, task, successful, value):
+        super(HybridFarm, self)._finish(task, successful, value)
+        self.finished.append(task)
+
+    def _drain(self, workerid):
+        """
+        Collect the results sent back by the worker.
+        """
+
+        conn = self.conns[workerid]
+        while True:
+            try:
+                if not conn.poll():
+                    break
+                tasknum, successful, value = conn.recv()
+            except (EOFError, IOError):
+                # Worker died; restarted by _collect
+                break
+
+            self.assigned[workerid].discard(tasknum)
+            task = self.tasks.get(tasknum)
+            if task is not None:
+                self._finish(task, successful, value)
+
+    def _requeue(self, task):
+        self.pending.appendleft(task)
+
+    def _collect(self, timeout=0):
+        """
+        Collect results and restart dead workers, failing their tasks.
+
+        Waits for at most timeout seconds for the first result.
+        """
+
+        if timeout:
+            select.select(self.conns, [], [], timeout)
+
+        for workerid, proc in enumerate(self.workers):
+            # Results sent before dying are still in the queue
+            alive = proc.is_alive()
+            self._drain(workerid)
+            if alive:
+                continue
+
+            proc.join()
+            error = "Worker died with exit code {}".format(proc.exitcode)
+            tasknums = sorted(self.assigned[workerid], reverse=True)
+            self.conns[workerid].close()
+            self._start_worker(workerid)
+
+            for tasknum in tasknums:
+                task = self.tasks.get(tasknum)
+                if task is not None:
+                    self._fail(task, error)
+
+        self._dispatch()
+
+    def _kill(self, proc):
+        if proc in self.pending:
+            self.pending.remove(proc)
+        self._finish(proc, False, "Killed")
+
+    def _join(self, proc):
+        pass
+
+    def _join_all_any(self, procs, return_on_any):
+        """
+        Join tasks, waking up whenever a worker sends results.
+        """
+
+        if procs is None:
+            procs = set(self.procs)
+        else:
+            procs = set(procs)
+
+        # Check all the tasks once, then only the ones finished since
+        count_joined = 0
+        candidates = list(procs)
+        while procs:
+            for p in candidates:
+                if p not in procs or not p.ready():
+                    continue
+
+                assert p in self.procs
+                self.procs.discard(p)
+                procs.discard(p)
+                count_joined += 1
+
+            if return_on_any and count_joined > 0:
+                return
+            if procs:
+                self.finished = []
+                self._collect(1)
+                candidates = self.finished
+
+    def _is_alive(self, proc):
+        return not proc.ready()
+
+def stealing_worker_run(workerid, taskq, conn, timeout):
+    """
+    Run tasks sent to this worker one at a time.
+
+    Results are sent back on the worker's own pipe.
+    """
+
+    title = spt.getproctitle()
+    title = "{} : {} : stealing".format(title, workerid + 1)
+    spt.setproctitle(title)
+
+    while True:
+        task = taskq.get()
+        if task is None:
+            break
+
+        tasknum, func, args, kwargs = task
+        successful, value = run_task(func, args, kwargs, timeout)
+        conn.send((tasknum, successful, value))
+
+class StealingFarm(WorkerFarm):
+    """
+    Run tasks on a fixed set of processes with work stealing.
+
+    Every worker has its own deque of pending tasks per priority class.
+    Tasks are dealt to the deques round robin. An idle worker takes the
+    highest priority task from the front of its own deque, or steals one
+    from the back of the longest deque of another worker.
+
+    If speculate is given, an idle worker with nothing left to steal
+    re-runs a task that has been running for more than speculate times the
+    median task runtime. The first copy to finish wins and the worker
+    running the other copy is restarted.
+
+    If timeout is given, tasks running longer than timeout seconds fail.
+    Workers that die or don't stop a timed out task are restarted. Failed
+    tasks are put back at the front of a deque up to retries times; tasks
+    that failed for good are recorded in failed.
+    """
+
+    def __init__(self, num_procs=None, speculate=None, timeout=None,
+                 retries=0):
+        super(StealingFarm, self).__init__(retries)
+
+        if num_procs is None:
+            num_procs = cpu_count()
+
+        self.num_procs = num_procs
+        self.speculate = speculate
+        self.timeout = timeout
+
+        self.nextworker = 0
+        self.priorities = {}
+        self.copies = collections.defaultdict(set)
+        self.durations = []
+
+        self.deques = [collections.defaultdict(collections.deque)
+                       for _ in xrange(num_procs)]
+        self.running = [None] * num_procs
+        self.started = [0.0] * num_procs
+
+        self.conns = [None] * num_procs
+        self.taskqs = [None] * num_procs
+        self.workers = [None] * num_procs
+        for workerid in xrange(num_procs):
+            self._start_worker(workerid)
+
+    def _start_worker(self, workerid):
+        """
+        Start a fresh worker process in the given slot.
+        """
+
+        # A pipe per worker; a worker killed while sending a result
+        # can't block or corrupt the results of the others
+        taskq = mp.Queue()
+        reader, writer = mp.Pipe(duplex=False)
+        pargs = (workerid, taskq, writer, self.timeout)
+        proc = mp.Process(target=stealing_worker_run, args=pargs)
+        proc.start()
+
+        # Only the worker writes; reads then fail once it is gone
+        writer.close()
+
+        self.conns[workerid] = reader
+        self.taskqs[workerid] = taskq
+        self.workers[workerid] = proc
+        self.running[workerid] = None
+
+    def _restart_worker(self, workerid):
+        """
+        Kill the worker and start a new one in its place.
+        """
+
+        task = self.running[workerid]
+        if task is not None and task.tasknum in self.copies:
+            self.copies[task.tasknum].discard(workerid)
+
+        self.workers[workerid].terminate()
+        self.workers[workerid].join()
+        self.conns[workerid].close()
+        self._start_worker(workerid)
+
+    @pypb.abs.runonce
+    def close(self):
+        self.kill_all()
+        self.join_all()
+
+        for taskq in self.taskqs:
+            taskq.put(None)
+        for proc in self.workers:
+            proc.join()
+
+    def spawn(self, func, *args, **kwargs):
+        """
+        Spawn a new task in the default priority class.
+
+        func       - The func to be run in a worker process.
+        *args      - The positional arguments for _func_
+        **kwargs   - The keyword arguments for _func_
+
+        Returns a Task object which can be used to get the result.
+        """
+
+        return self.spawn_priority(DEFAULT_PRIORITY, func, *args, **kwargs)
+
+    def spawn_priority(self, priority, func, *args, **kwargs):
+        """
+        Spawn a new task in the given priority class.
+
+        priority   - Priority class of the task; lower runs first.
+        func       - The func to be run in a worker process.
+        *args      - The positional arguments for _func_
+        **kwargs   - The keyword arguments for _func_
+        """
+
+        task = self._new_task(func, args, kwargs)
+        self.priorities[task.tasknum] = priority
+
+        deque = self.deques[self.nextworker][priority]
+        deque.append(task)
+        self.nextworker = (self.nextworker + 1) % self.num_procs
+
+        self._schedule(0)
+        return task
+
+    def make_queue(self, maxsize=0):
+        return mp.Queue(maxsize)
+
+    def _pick(self, workerid):
+        """
+        Return the next task for the worker, stealing if required.
+        """
+
+        prios = set()
+        for deques in self.deques:
+            prios.update(p for p, d in deques.iteritems() if d)
+        if not prios:
+            return None
+        prio = min(prios)
+
+        own = self.deques[workerid][prio]
+        if own:
+            return own.popleft()
+
+        victim = max(self.deques, key=lambda ds: len(ds[prio]))
+        return victim[prio].pop()
+
+    def _straggler(self, now):
+        """
+        Return the running task most worth speculating on.
+        """
+
+        if len(self.durations) < SPECULATE_MIN_DONE:
+            return None
+
+        durations = sorted(self.durations)
+        limit = self.speculate * durations[len(durations) // 2]
+
+        best, best_runtime = None, limit
+        for workerid, task in enumerate(self.running):
+            if task is None or len(self.copies[task.tasknum]) > 1:
+                continue
+            # A copy failed already; another one would likely fail too
+            if self.failures.get(task.tasknum):
+                continue
+
+            runtime = now - self.started[workerid]
+            if runtime > best_runtime:
+                best, best_runtime = task, runtime
+
+        return best
+
+    def _dispatch(self, workerid, task):
+        """
+        Send the task to the worker.
+        """
+
+        func, args, kwargs = self.entries[task.tasknum]
+        self.taskqs[workerid].put((task.tasknum, func, args, kwargs))
+
+        self.running[workerid] = task
+        self.started[workerid] = time.time()
+        self.copies[task.tasknum].add(workerid)
+
+    def _finish(self, task, successful, value):
+        super(StealingFarm, self)._finish(task, successful, value)
+        self.priorities.pop(task.tasknum, None)
+
+        # Restart workers still running other copies of the task
+        for workerid in self.copies.pop(task.tasknum, ()):
+            if self.running[workerid] is task:
+                self._restart_worker(workerid)
+
+    def _collect(self, timeout):
+        """
+        Collect results, waiting for at most timeout seconds for the first.
+        """
+
+        if timeout:
+            select.select(self.conns, [], [], timeout)
+
+        results = []
+        for workerid, conn in enumerate(self.conns):
+            try:
+                while conn.poll():
+                    results.append((workerid,) + conn.recv())
+            except (EOFError, IOError):
+                # Worker died; restarted by _check_workers
+                pass
+
+        now = time.time()
+        for workerid, tasknum, successful, value in results:
+            task = self.running[workerid]
+            if task is None or task.tasknum != tasknum:
+                # Result of a copy that was already restarted
+                continue
+
+            self.running[workerid] = None
+            self.copies[tasknum].discard(workerid)
+            if task.ready():
+                continue
+
+            if successful:
+                self.durations.append(now - self.started[workerid])
+                self._finish(task, successful, value)
+            else:
+                self._fail(task, value)
+
+    def _fail(self, task, error):
+        if task.ready():
+            return
+
+        # Every failed copy counts; another copy may still succeed
+        if self.copies[task.tasknum]:
+            self.failures[task.tasknum] += 1
+            return
+
+        super(StealingFarm, self)._fail(task, error)
+
+    def _requeue(self, task):
+        priority = self.priorities[task.tasknum]
+        self.deques[self.nextworker][priority].appendleft(task)
+        self.nextworker = (self.nextworker + 1) % self.num_procs
+
+    def _failed_info(self, task, info):
+        info["priority"] = self.priorities[task.tasknum]
+        return info
+
+    def _check_workers(self, now):
+        """
+        Restart dead and stuck workers, failing their tasks.
+        """
+
+        for workerid, proc in enumerate(self.workers):
+            task = self.running[workerid]
+            stuck = (task is not None and self.timeout is not None and
+                     now - self.started[workerid] > self.timeout + TIMEOUT_GRACE)
+
+            if not proc.is_alive():
+                error = "Worker died with exit code {}".format(proc.exitcode)
+                proc.join()
+                self.conns[workerid].close()
+                self._start_worker(workerid)
+            elif stuck:
+                error = "Worker killed after timeout"
+                self._restart_worker(workerid)
+            else:
+                continue
+
+            if task is not None:
+                self.copies[task.tasknum].discard(workerid)
+                self._fail(task, error)
+
+    def _schedule(self, timeout):
+        """
+        Collect finished results and give work to idle workers.
+        """
+
+        self._collect(timeout)
+        self._check_workers(time.time())
+
+        now = time.time()
+        for workerid in xrange(self.num_procs):
+            if self.running[workerid] is not None:
+                continue
 
+            task = self._pick(workerid)
+            if task is None and self.speculate is not None:
+                task = self._straggler(now)
+            if task is None:
+                break
+
+            self._dispatch(workerid, task)
+
+    def _join_all_any(self, procs, return_on_any):
+        """
+        Join tasks while keeping the workers busy.
+        """
+
+        if procs is None:
+            procs = set(self.procs)
+        else:
+            procs = set(procs)
+
+        count_joined = 0
+        while procs:
+            for p in list(procs):
+                assert p in self.procs
+
+                if not p.ready():
+                    continue
+
+                self.procs.discard(p)
+                procs.discard(p)
+                count_joined += 1
+
+            if return_on_any and count_joined > 0:
+                return
+            if procs:
+                self._schedule(1)
+
+    def _kill(self, proc):
+        for deques in self.deques:
+            for deque in deques.itervalues():
+                if proc in deque:
+                    deque.remove(proc)
+
+        self._finish(proc, False, "Killed")
+
+    def _join(self, proc):
+        pass
+
+    def _is_alive(self, proc):
+        return not proc.ready()
+
+class AsyncioFarm(TaskFarm):
+    """
+    Spawn tasks on an asyncio event loop.
+
+    The event loop is run only while joining, as the current event loop;
+    by default it is the current event loop. At most max_tasks tasks run
+    at any time; the rest wait in a queue for a free slot. Blocking
+    functions can be run on the executor with spawn_blocking or, from
+    inside a coroutine, with run_blocking. The executor is either "thread",
+    "process" or a concurrent.futures Executor.
+    """
+
+    def __init__(self, max_tasks=sys.maxsize, loop=None, executor="thread"):
+        if asyncio is None:
+            raise ImportError("AsyncioFarm requires asyncio or trollius")
+
+        super(AsyncioFarm, self).__init__()
+
+        self.loop = asyncio.get_event_loop() if loop is None else loop
+
+        self.max_tasks = max_tasks
+        self.running = 0
+        self.pending = collections.deque()
+        self.inner = {}
+
+        self.own_executor = executor == "process"
+        if executor == "thread":
+            self.executor = None
+        elif executor == "process":
+            from concurrent.futures import ProcessPoolExecutor
+            self.executor = ProcessPoolExecutor()
+        else:
+            self.executor = executor
+
+    @pypb.abs.runonce
+    def close(self):
+        self.kill_all()
+        self.join_all()
+
+        # Let the cancelled tasks run their cleanup
+        if self.inner:
+            inner = list(self.inner.values())
+            self._run(asyncio.gather(*inner, return_exceptions=True))
+
+        if self.own_executor:
+            self.executor.shutdown()
+
+    def _run(self, future):
+        """
+        Run the loop till the future is done, as the current event loop.
+
+        Coroutines using the default loop then run on this loop.
+        """
+
+        try:
+            old_loop = asyncio.get_event_loop()
+        except (RuntimeError, AssertionError):
+            # No current event loop in this thread
+            old_loop = None
+
+        asyncio.set_event_loop(self.loop)
+        try:
+            return self.loop.run_until_complete(future)
+        finally:
+            asyncio.set_event_loop(old_loop)
+
+    def spawn(self, func, *args, **kwargs):
+        """
+        Spawn a new task.
+
+        func       - The coroutine function to be run in the new task.
+        *args      - The positional arguments for _func_
+        **kwargs   - The keyword arguments for _func_
+
+        If func returns something which is not awaitable, it is taken
+        as the result of the task.
+
+        Returns a Future with the result of the task.
+        """
+
+        handle = asyncio.Future(loop=self.loop)
+        self.procs.add(handle)
+
+        self.pending.append((handle, func, args, kwargs))
+        self._start_pending()
+
+        return handle
+
+    def spawn_blocking(self, func, *args, **kwargs):
+        """
+        Spawn a new task running a blocking function on the executor.
+        """
+
+        return self.spawn(self.run_blocking, func, *args, **kwargs)
+
+    def run_blocking(self, func, *args, **kwargs):
+        """
+        Run the blocking function on the executor and return a Future.
+        """
+
+        func = functools.partial(func, *args, **kwargs)
+        return self.loop.run_in_executor(self.executor, func)
+
+    def make_queue(self, maxsize=0):
+        try:
+            return asyncio.Queue(maxsize, loop=self.loop)
+        except TypeError:
+            # Newer asyncio versions bind the queue to the running loop
+            return asyncio.Queue(maxsize)
+
+    def _start_pending(self):
+        """
+        Start pending tasks while there are free slots.
+        """
+
+        while self.pending and self.running < self.max_tasks:
+            handle, func, args, kwargs = self.pending.popleft()
+            if handle.done():
+                continue
+
+            try:
+                ret = func(*args, **kwargs)
+            except Exception as e: # pylint: disable=broad-except
+                handle.set_exception(e)
+                continue
+
+            try:
+                inner = asyncio.ensure_future(ret, loop=self.loop)
+            except TypeError:
+                handle.set_result(ret)
+                continue
+
+            self.running += 1
+            self.inner[handle] = inner
+            inner.add_done_callback(functools.partial(self._finish, handle))
+
+    def _finish(self, handle, inner):
+        """
+        Copy the result of the finished task and start the next ones.
+        """
+
+        self.running -= 1
+        self.inner.pop(handle, None)
+
+        if not handle.done():
+            if inner.cancelled():
+                handle.cancel()
+            elif inner.exception() is not None:
+                handle.set_exception(inner.exception())
+            else:
+                handle.set_result(inner.result())
+
+        self._start_pending()
+
+    def _join_all_any(self, procs, return_on_any):
+        """
+        Run the event loop till the tasks have finished.
+        """
+
+        if procs is None:
+            procs = set(self.procs)
+        else:
+            procs = set(procs)
+
+        waiter = asyncio.Future(loop=self.loop)
+
+        def check(_):
+            """
+            Wake up the waiter if enough tasks have finished.
+            """
+
+            count_done = sum(1 for p in procs if p.done())
+            if waiter.done():
+                return
+            if (return_on_any and count_done > 0) or count_done == len(procs):
+                waiter.set_result(None)
+
+        for p in procs:
+            assert p in self.procs
+            p.add_done_callback(check)
+
+        check(None)
+        if not waiter.done():
+            self._run(waiter)
+
+        for p in procs:
+            p.remove_done_callback(check)
+            if p.done():
+                self._join(p)
+                self.procs.discard(p)
+
+    def _kill(self, proc):
+        inner = self.inner.get(proc)
+        if inner is not None:
+            inner.cancel()
+        proc.cancel()
+
+    def _join(self, proc):
+        # Mark any exception as retrieved
+        if not proc.cancelled():
+            proc.exception()
+
+    def _is_alive(self, proc):
+        return not proc.done()
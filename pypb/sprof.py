@@ -0,0 +1,163 @@
+"""
+Signal driven sampling CPU profiler.
+
+Samples are written as collapsed stacks; the format used by flamegraph.pl.
+
+NOTE: Python runs signal handlers in the main thread between bytecodes.
+While the main thread is blocked in C code (eg. sleep, select or a lock
+wait) pending SIGPROF ticks coalesce into one, so the samples of that
+time are dropped, not delayed; the CPU time of the other threads then
+goes mostly unrecorded. Daemons whose main thread waits in join_all are
+badly undersampled; profile them from a main thread that stays busy.
+"""
+
+from __future__ import division, print_function
+
+import sys
+import atexit
+import signal
+import threading
+import collections
+
+import pypb.awriter as awriter
+
+# Default seconds of CPU time between samples
+DEFAULT_INTERVAL = 0.01
+
+def frame_name(frame):
+    """
+    Return the name of the function of the frame.
+    """
+
+    code = frame.f_code
+    name = "{} ({}:{})".format(code.co_name, code.co_filename,
+                                code.co_firstlineno)
+    # The collapsed stack format uses ';' as separator
+    return name.replace(";", ":")
+
+def collapse(frame):
+    """
+    Return the stack of the frame as a collapsed stack string.
+    """
+
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+
+    return ";".join(reversed(names))
+
+class SamplingProfiler(object):
+    """
+    Sample the stacks of all threads every interval seconds of CPU time.
+
+    Uses SIGPROF and ITIMER_PROF.
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self.counts = collections.Counter()
+        self.running = False
+        self.old_handler = None
+
+    def _sample(self, _, frame):
+        """
+        Record the stacks of all the threads.
+        """
+
+        main = threading.current_thread().ident
+        if frame is not None:
+            self.counts[collapse(frame)] += 1
+
+        for ident, tframe in sys._current_frames().items(): # pylint: disable=protected-access
+            if ident != main:
+                self.counts[collapse(tframe)] += 1
+
+    def start(self):
+        """
+        Start sampling.
+        """
+
+        if self.running:
+            return
+
+        self.old_handler = signal.signal(signal.SIGPROF, self._sample)
+        # Restart system calls interrupted by the timer
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.running = True
+
+    def stop(self):
+        """
+        Stop sampling.
+        """
+
+        if not self.running:
+            return
+
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.old_handler or signal.SIG_DFL)
+        self.running = False
+
+    def reset(self):
+        """
+        Forget the samples taken so far.
+        """
+
+        self.counts = collections.Counter()
+
+    def write(self, fname):
+        """
+        Write the samples as collapsed stacks to the file.
+        """
+
+        counts = self.counts
+        with awriter.open(fname, "wb") as fobj:
+            for stack, count in sorted(counts.iteritems()):
+                fobj.write("{} {}\n".format(stack, count))
+
+class ProfilerToggle(object):
+    """
+    Start and stop a profiler every time a signal is received.
+
+    Every time the profiler is stopped, the samples are written to
+    '<prefix>.<n>.collapsed' and then discarded. A running profiler is
+    stopped and its samples are written at exit.
+    """
+
+    def __init__(self, prefix, signum=signal.SIGUSR2,
+                 interval=DEFAULT_INTERVAL):
+        self.prefix = prefix
+        self.profiler = SamplingProfiler(interval)
+        self.dumps = 0
+
+        signal.signal(signum, self._toggle)
+        atexit.register(self.stop)
+
+    def _toggle(self, _signum, _frame):
+        """
+        Start the profiler if stopped, stop it if running.
+        """
+
+        if self.profiler.running:
+            self.stop()
+        else:
+            self.profiler.start()
+
+    def stop(self):
+        """
+        Stop the profiler, if running, and write the samples.
+        """
+
+        if not self.profiler.running:
+            return
+
+        self.profiler.stop()
+
+        self.dumps += 1
+        fname = "{}.{}.collapsed".format(self.prefix, self.dumps)
+        self.profiler.write(fname)
+        self.profiler.reset()
+
+        print("Profile written to: {}".format(fname))
+        sys.stdout.flush()
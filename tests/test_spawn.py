@@ -0,0 +1,163 @@
+"""
+Tests for pypb.spawn.
+"""
+
+import os
+import time
+import shutil
+import signal
+import tempfile
+import unittest
+from contextlib import contextmanager
+
+from pypb.spawn import ProcessFarm, StealingFarm
+
+def noop():
+    pass
+
+def nap(secs):
+    time.sleep(secs)
+    return secs
+
+def nap_fail(secs):
+    time.sleep(secs)
+    raise ValueError("failed after {}".format(secs))
+
+def record(fname, label):
+    with open(fname, "a") as fobj:
+        fobj.write(label + "\n")
+
+def read_records(fname):
+    with open(fname) as fobj:
+        return fobj.read().split()
+
+def nap_first(fname, first, later):
+    # The first call naps for first seconds; the others for later seconds
+    calls = len(read_records(fname)) if os.path.exists(fname) else 0
+    record(fname, "call")
+    time.sleep(first if calls == 0 else later)
+    return calls
+
+def die_first(fname):
+    # The first call kills the worker; the others succeed
+    calls = len(read_records(fname)) if os.path.exists(fname) else 0
+    record(fname, "call")
+    if calls == 0:
+        os._exit(1) # pylint: disable=protected-access
+    return calls
+
+class Hung(Exception):
+    pass
+
+@contextmanager
+def deadline(secs):
+    """
+    Raise Hung if the block runs longer than secs seconds.
+    """
+
+    def handler(_signum, _frame):
+        raise Hung("Timed out after {} seconds".format(secs))
+
+    old = signal.signal(signal.SIGALRM, handler)
+    signal.alarm(secs)
+    try:
+        yield
+    finally:
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, old)
+
+class ProcessFarmTest(unittest.TestCase):
+
+    def test_account_many_tasks(self):
+        # The stats of finished tasks must not fill up the pipe
+        ntasks = 400
+
+        with ProcessFarm(max_procs=8, account=True) as farm:
+            for _ in xrange(ntasks):
+                farm.spawn(noop)
+            farm.join_all()
+
+            summary = farm.stats_summary()
+
+        self.assertEqual(summary["noop"]["count"], ntasks)
+
+class StealingFarmTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, "records")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_speculated_first_copy_wins(self):
+        # The copy is slower; the first copy's result must be kept and
+        # the worker running the copy restarted
+        with deadline(30), StealingFarm(3, speculate=2.0) as farm:
+            for _ in xrange(6):
+                farm.spawn(nap, 0.05)
+            slow = farm.spawn(nap_first, self.fname, 1.5, 60)
+            farm.join_all()
+
+            self.assertEqual(slow.get(), 0)
+            self.assertEqual(read_records(self.fname), ["call", "call"])
+
+            # All the workers must still be usable
+            tasks = [farm.spawn(nap, 0.05) for _ in xrange(6)]
+            farm.join_all()
+            self.assertTrue(all(t.successful() for t in tasks))
+
+    def test_killed_worker_requeued(self):
+        with deadline(30), StealingFarm(2, retries=1) as farm:
+            task = farm.spawn(die_first, self.fname)
+            farm.join_all()
+
+            self.assertEqual(task.get(), 1)
+            self.assertEqual(farm.failed, [])
+
+    def test_killed_worker_failed(self):
+        with deadline(30), StealingFarm(2, retries=0) as farm:
+            task = farm.spawn(die_first, self.fname)
+            farm.join_all()
+
+            self.assertFalse(task.successful())
+            self.assertEqual([info["tasknum"] for info in farm.failed],
+                             [task.tasknum])
+
+    def test_priority_order(self):
+        with deadline(30), StealingFarm(1) as farm:
+            # Keeps the worker busy while the others are queued
+            farm.spawn(nap, 0.5)
+            for i in xrange(3):
+                farm.spawn_priority(2, record, self.fname, "low%d" % i)
+                farm.spawn_priority(1, record, self.fname, "high%d" % i)
+            farm.join_all()
+
+        self.assertEqual(read_records(self.fname),
+                         ["high0", "high1", "high2", "low0", "low1", "low2"])
+
+    def test_failing_straggler_speculated(self):
+        # Failed copies must count, or the straggler is re-run forever
+        with deadline(30), StealingFarm(3, speculate=2.0, retries=0) as farm:
+            quick = [farm.spawn(nap, 0.05) for _ in xrange(6)]
+            slow = farm.spawn(nap_fail, 1.5)
+            farm.join_all()
+
+            self.assertTrue(all(t.successful() for t in quick))
+            self.assertFalse(slow.successful())
+            self.assertEqual([info["tasknum"] for info in farm.failed],
+                             [slow.tasknum])
+
+    def test_timed_out_straggler_speculated(self):
+        with deadline(60), StealingFarm(3, speculate=2.0, timeout=2,
+                                        retries=1) as farm:
+            for _ in xrange(6):
+                farm.spawn(nap, 0.05)
+            slow = farm.spawn(nap, 10)
+            farm.join_all()
+
+            self.assertFalse(slow.successful())
+            self.assertEqual(len(farm.failed), 1)
+
+if __name__ == "__main__":
+    unittest.main()